@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         LMArena API Bridge
 // @namespace    http://tampermonkey.net/
-// @version      2.5
+// @version      2.6
 // @description  Bridges LMArena to a local API server via WebSocket for streamlined automation.
 // @author       Lianues
 // @match        https://lmarena.ai/*
@@ -15,14 +15,17 @@
     'use strict';
 
     // --- 配置 ---
-    const SERVER_URL = "ws://localhost:5102/ws"; // 与 api_server.py 中的端口匹配
+    const SERVER_URL = "ws://localhost:5102/ws?binary=1"; // 与 api_server.py 中的端口匹配；binary=1 声明本脚本支持接收二进制帧
     let socket;
     let isCaptureModeActive = false; // ID捕获模式的开关
+    const textEncoder = new TextEncoder(); // 以二进制帧发送，服务端可直接解析 UTF-8 字节
+    const textDecoder = new TextDecoder(); // 服务端的聊天载荷同样以二进制帧下发
 
     // --- 核心逻辑 ---
     function connect() {
         console.log(`[API Bridge] 正在连接到本地服务器: ${SERVER_URL}...`);
         socket = new WebSocket(SERVER_URL);
+        socket.binaryType = 'arraybuffer';
 
         socket.onopen = () => {
             console.log("[API Bridge] ✅ 与本地服务器的 WebSocket 连接已建立。");
@@ -31,7 +34,8 @@
 
         socket.onmessage = async (event) => {
             try {
-                const message = JSON.parse(event.data);
+                const raw = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data);
+                const message = JSON.parse(raw);
 
                 // 检查是否是指令，而不是标准的聊天请求
                 if (message.command) {
@@ -195,7 +199,7 @@
                 request_id: requestId,
                 data: data
             };
-            socket.send(JSON.stringify(message));
+            socket.send(textEncoder.encode(JSON.stringify(message)));
         } else {
             console.error("[API Bridge] 无法发送数据，WebSocket 连接未打开。");
         }
@@ -2,6 +2,7 @@
 # 新一代 LMArena Bridge 后端服务
 
 import asyncio
+import contextlib
 import json
 import logging
 import os
@@ -10,10 +11,13 @@ import subprocess
 import time
 import uuid
 import re
-import threading
 import random
 import mimetypes
-from datetime import datetime
+import posixpath
+import orjson
+from functools import lru_cache
+from urllib.parse import urlsplit
+from collections import deque
 from contextlib import asynccontextmanager
 
 import uvicorn
@@ -24,85 +28,202 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse, Response
 
 # --- 内部模块导入 ---
-from modules.file_uploader import upload_to_file_bed
+from modules.file_uploader import upload_base64_to_file_bed, split_data_uri
+from modules import file_uploader
 
 
 # --- 基础配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- 响应类 ---
+class ORJSONResponse(JSONResponse):
+    """使用 orjson 序列化的 JSON 响应（FastAPI 自带的 ORJSONResponse 已弃用）。"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+# --- 响应通道 ---
+# 每个响应通道最多缓冲的消息数。消费者（SSE 客户端）跟不上时，WebSocket 端会暂停接收，
+# 将背压传回浏览器，而不是无限制地占用内存。
+RESPONSE_CHANNEL_MAXSIZE = 256
+# 通道写满后 WebSocket 端最多等待的秒数。所有请求共用同一条 WebSocket，
+# 超时后放弃该请求，避免一个不再读取的消费者阻塞其他请求。
+RESPONSE_CHANNEL_PUT_TIMEOUT = 10
+
+class _Channel:
+    """
+    单生产者 / 单消费者的轻量响应通道：deque 缓冲 + Event 唤醒。
+    WebSocket 端写入浏览器数据，_process_lmarena_stream 读取；
+    相比 asyncio.Queue 省去了每次 put/get 的 waiter 管理开销。
+    maxsize > 0 时为有界通道：put 在缓冲已满时等待，put_nowait 不受容量限制（用于控制消息）。
+    """
+    __slots__ = ('_buf', '_event', '_not_full', '_maxsize', '_closed')
+
+    def __init__(self, maxsize: int = 0):
+        self._buf = deque()
+        self._event = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._maxsize = maxsize
+        self._closed = False
+
+    def put_nowait(self, item):
+        """写入一条数据并唤醒消费者，不检查容量。"""
+        self._buf.append(item)
+        self._event.set()
+
+    async def put(self, item, timeout: float | None = None) -> bool:
+        """
+        写入一条数据；缓冲已满时最多等待 timeout 秒，直到消费者取走数据。
+        返回 False 表示等待超时或通道已关闭，数据被丢弃。
+        """
+        if self._maxsize and len(self._buf) >= self._maxsize and not self._closed:
+            try:
+                await asyncio.wait_for(self._wait_not_full(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        if self._closed:
+            return False
+        self.put_nowait(item)
+        return True
+
+    async def _wait_not_full(self):
+        while len(self._buf) >= self._maxsize and not self._closed:
+            self._not_full.clear()
+            await self._not_full.wait()
+
+    async def get(self):
+        """等待并取出一条数据。"""
+        while not self._buf:
+            self._event.clear()
+            await self._event.wait()
+        return self._take()
+
+    def get_nowait(self):
+        """取出一条已就绪的数据；没有数据时抛出 asyncio.QueueEmpty。"""
+        if not self._buf:
+            raise asyncio.QueueEmpty
+        return self._take()
+
+    def _take(self):
+        item = self._buf.popleft()
+        if self._maxsize:
+            self._not_full.set()
+        return item
+
+    def close(self):
+        """消费者不再读取时调用：唤醒并放弃所有等待中的写入。"""
+        self._closed = True
+        self._not_full.set()
+
+def _close_channel(request_id: str) -> bool:
+    """从 response_channels 中移除并关闭通道；通道不存在时返回 False。"""
+    channel = response_channels.pop(request_id, None)
+    if channel is None:
+        return False
+    channel.close()
+    return True
+
 # --- 全局状态与配置 ---
 CONFIG = {} # 存储从 config.jsonc 加载的配置
 # browser_ws 用于存储与单个油猴脚本的 WebSocket 连接。
 # 注意：此架构假定只有一个浏览器标签页在工作。
 # 如果需要支持多个并发标签页，需要将此扩展为字典管理多个连接。
 browser_ws: WebSocket | None = None
-# response_channels 用于存储每个 API 请求的响应队列。
-# 键是 request_id，值是 asyncio.Queue。
-response_channels: dict[str, asyncio.Queue] = {}
-last_activity_time = None # 记录最后一次活动的时间
-idle_monitor_thread = None # 空闲监控线程
-main_event_loop = None # 主事件循环
+# 当前连接的油猴脚本是否支持接收二进制帧（新版脚本在连接地址中带上 ?binary=1 声明）。
+# 旧版脚本只能解析文本帧，收到二进制帧会静默失败，因此默认以文本帧发送。
+browser_ws_binary = False
+# response_channels 用于存储每个 API 请求的响应通道。
+# 键是 request_id，值是 _Channel。
+response_channels: dict[str, _Channel] = {}
+last_activity_time: float = 0.0 # 记录最后一次活动的时间（time.monotonic() 秒数，不受系统时钟调整影响）
+idle_monitor_task = None # 空闲监控任务
+IDLE_RESTART_TIMEOUT = None # 空闲重启阈值（秒），由 load_config 更新；None 表示不检查
+cf_refresher_task = None # 人机验证刷新指令发送任务
 # 新增：用于跟踪是否因人机验证而刷新
 IS_REFRESHING_FOR_VERIFICATION = False
 
+# --- 发往油猴脚本的控制指令 ---
+# 指令内容固定且均为 ASCII，启动时序列化一次，之后直接复用字符串
+_CMD_RECONNECT = orjson.dumps({"command": "reconnect"}).decode()
+_CMD_REFRESH = orjson.dumps({"command": "refresh"}).decode()
+_CMD_SEND_PAGE_SOURCE = orjson.dumps({"command": "send_page_source"}).decode()
+_CMD_ACTIVATE_ID_CAPTURE = orjson.dumps({"command": "activate_id_capture"}).decode()
+
 
 # --- 模型映射 ---
 # MODEL_NAME_TO_ID_MAP 现在将存储更丰富的对象： { "model_name": {"id": "...", "type": "..."} }
 MODEL_NAME_TO_ID_MAP = {}
+MODELS_RESPONSE_BYTES = b"" # /v1/models 的响应体，随模型映射一起生成
 MODEL_ENDPOINT_MAP = {} # 新增：用于存储模型到 session/message ID 的映射
 DEFAULT_MODEL_ID = None # 默认模型id: None
+IMAGE_MODEL_NAMES = frozenset() # 类型为 image 的模型名，随模型映射一起生成
+
+# 端点映射在加载时预先规整，请求处理时只需解包：
+# { "model_name": (is_list, ((session_id, message_id, mode, battle_target, ids_valid), ...)) }
+_ENDPOINT_CANDIDATES = {}
+# 全局默认 ID，格式同上面的单个端点元组，随 config.jsonc 一起刷新
+_DEFAULT_ENDPOINT = (None, None, None, None, False)
+
+_INVALID_IDS_DETAIL = "最终确定的会话ID或消息ID无效。请检查 'model_endpoint_map.json' 和 'config.jsonc' 中的配置，或运行 `id_updater.py` 来更新默认值。"
+
+def _ids_valid(session_id, message_id) -> bool:
+    """会话ID与消息ID均已填写且不是 "YOUR_..." 占位符时才有效。"""
+    return bool(session_id and message_id and "YOUR_" not in session_id and "YOUR_" not in message_id)
+
+def _build_endpoint_candidates():
+    """将 MODEL_ENDPOINT_MAP 中的列表/单个映射统一规整为端点元组。"""
+    global _ENDPOINT_CANDIDATES
+    candidates = {}
+    for model_name, mapping_entry in MODEL_ENDPOINT_MAP.items():
+        if isinstance(mapping_entry, list):
+            is_list, entries = True, mapping_entry
+        elif isinstance(mapping_entry, dict):
+            is_list, entries = False, [mapping_entry]
+        else:
+            continue
+        endpoints = tuple(
+            (
+                entry.get("session_id"),
+                entry.get("message_id"),
+                entry.get("mode"),
+                entry.get("battle_target"),
+                _ids_valid(entry.get("session_id"), entry.get("message_id")),
+            )
+            for entry in entries if isinstance(entry, dict) and entry
+        )
+        if endpoints:
+            candidates[model_name] = (is_list, endpoints)
+    _ENDPOINT_CANDIDATES = candidates
 
 def load_model_endpoint_map():
     """从 model_endpoint_map.json 加载模型到端点的映射。"""
     global MODEL_ENDPOINT_MAP
     try:
-        with open('model_endpoint_map.json', 'r', encoding='utf-8') as f:
+        with open('model_endpoint_map.json', 'rb') as f:
             content = f.read()
             # 允许空文件
             if not content.strip():
                 MODEL_ENDPOINT_MAP = {}
             else:
-                MODEL_ENDPOINT_MAP = json.loads(content)
+                MODEL_ENDPOINT_MAP = orjson.loads(content)
         logger.info(f"成功从 'model_endpoint_map.json' 加载了 {len(MODEL_ENDPOINT_MAP)} 个模型端点映射。")
     except FileNotFoundError:
         logger.warning("'model_endpoint_map.json' 文件未找到。将使用空映射。")
         MODEL_ENDPOINT_MAP = {}
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"加载或解析 'model_endpoint_map.json' 失败: {e}。将使用空映射。")
         MODEL_ENDPOINT_MAP = {}
+    _build_endpoint_candidates()
+
+# 单次扫描匹配字符串字面量或注释：字符串原样保留（避免误删其中的 "//"），注释替换为空。
+_JSONC_RE = re.compile(r'"(?:\\.|[^"\\])*"|/\*.*?\*/|//[^\n]*', re.DOTALL)
 
 def _parse_jsonc(jsonc_string: str) -> dict:
     """
     稳健地解析 JSONC 字符串，移除注释。
     """
-    lines = jsonc_string.splitlines()
-    no_comments_lines = []
-    in_block_comment = False
-    for line in lines:
-        stripped_line = line.strip()
-        if in_block_comment:
-            if '*/' in stripped_line:
-                in_block_comment = False
-                line = stripped_line.split('*/', 1)[1]
-            else:
-                continue
-        
-        if '/*' in line and not in_block_comment:
-            before_comment, _, after_comment = line.partition('/*')
-            if '*/' in after_comment:
-                _, _, after_block = after_comment.partition('*/')
-                line = before_comment + after_block
-            else:
-                line = before_comment
-                in_block_comment = True
-
-        if line.strip().startswith('//'):
-            continue
-        
-        no_comments_lines.append(line)
-
-    return json.loads("\n".join(no_comments_lines))
+    return orjson.loads(_JSONC_RE.sub(lambda m: m.group(0) if m.group(0)[0] == '"' else '', jsonc_string))
 
 def load_config():
     """从 config.jsonc 加载配置，并处理 JSONC 注释。"""
@@ -115,23 +236,42 @@ def load_config():
         # 打印关键配置状态
         logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if CONFIG.get('tavern_mode_enabled') else '❌ 禁用'}")
         logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if CONFIG.get('bypass_enabled') else '❌ 禁用'}")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
         logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将使用默认配置。")
         CONFIG = {}
+    _snapshot_idle_restart_timeout()
+    _snapshot_default_endpoint()
+
+def _snapshot_default_endpoint():
+    """将全局默认的会话ID/消息ID及其有效性折算为一个端点元组。"""
+    global _DEFAULT_ENDPOINT
+    session_id = CONFIG.get("session_id")
+    message_id = CONFIG.get("message_id")
+    _DEFAULT_ENDPOINT = (session_id, message_id, None, None, _ids_valid(session_id, message_id))
+
+def _snapshot_idle_restart_timeout():
+    """将空闲重启配置折算为单个阈值，供 idle_monitor 直接读取；None 表示不检查。"""
+    global IDLE_RESTART_TIMEOUT
+    timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
+    # 未启用，或超时设置为-1时，禁用重启检查
+    if not CONFIG.get("enable_idle_restart", False) or timeout == -1:
+        IDLE_RESTART_TIMEOUT = None
+    else:
+        IDLE_RESTART_TIMEOUT = timeout
 
 def load_model_map():
     """从 models.json 加载模型映射，支持 'id:type' 格式。"""
-    global MODEL_NAME_TO_ID_MAP
+    global MODEL_NAME_TO_ID_MAP, MODELS_RESPONSE_BYTES, IMAGE_MODEL_NAMES
     try:
-        with open('models.json', 'r', encoding='utf-8') as f:
-            raw_map = json.load(f)
+        with open('models.json', 'rb') as f:
+            raw_map = orjson.loads(f.read())
             
         processed_map = {}
         for name, value in raw_map.items():
             if isinstance(value, str) and ':' in value:
-                parts = value.split(':', 1)
-                model_id = parts[0] if parts[0].lower() != 'null' else None
-                model_type = parts[1]
+                model_id, _, model_type = value.partition(':')
+                if model_id.lower() == 'null':
+                    model_id = None
                 processed_map[name] = {"id": model_id, "type": model_type}
             else:
                 # 默认或旧格式处理
@@ -140,10 +280,29 @@ def load_model_map():
         MODEL_NAME_TO_ID_MAP = processed_map
         logger.info(f"成功从 'models.json' 加载并解析了 {len(MODEL_NAME_TO_ID_MAP)} 个模型。")
 
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
         logger.error(f"加载 'models.json' 失败: {e}。将使用空模型列表。")
         MODEL_NAME_TO_ID_MAP = {}
 
+    IMAGE_MODEL_NAMES = frozenset(
+        name for name, info in MODEL_NAME_TO_ID_MAP.items() if info["type"] == "image"
+    )
+
+    # 模型列表只在此处变化，预先序列化 /v1/models 的响应体
+    created = int(time.time())
+    MODELS_RESPONSE_BYTES = orjson.dumps({
+        "object": "list",
+        "data": [
+            {
+                "id": model_name, 
+                "object": "model",
+                "created": created,
+                "owned_by": "LMArenaBridge"
+            }
+            for model_name in MODEL_NAME_TO_ID_MAP
+        ],
+    })
+
 # --- 公告处理 ---
 def check_and_display_announcement():
     """检查并显示一次性公告。"""
@@ -152,8 +311,8 @@ def check_and_display_announcement():
         try:
             logger.info("="*60)
             logger.info("📢 检测到更新公告，内容如下:")
-            with open(announcement_file, 'r', encoding='utf-8') as f:
-                announcement = json.load(f)
+            with open(announcement_file, 'rb') as f:
+                announcement = orjson.loads(f.read())
                 title = announcement.get("title", "公告")
                 content = announcement.get("content", [])
                 
@@ -162,7 +321,7 @@ def check_and_display_announcement():
                     logger.info(f"   {line}")
                 logger.info("="*60)
 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.error(f"无法解析公告文件 '{announcement_file}'。文件内容可能不是有效的JSON。")
         except Exception as e:
             logger.error(f"读取公告文件时发生错误: {e}")
@@ -175,9 +334,15 @@ def check_and_display_announcement():
 
 # --- 更新检查 ---
 GITHUB_REPO = "Lianues/LMArenaBridge"
+UPDATE_DOWNLOAD_CHUNK_SIZE = 64 * 1024 # 更新包下载时每次读取的字节数
+UPDATE_SPOOL_MAX_SIZE = 8 * 1024 * 1024 # 更新包超过该大小时落盘，否则留在内存
 
 def download_and_extract_update(version):
     """下载并解压最新版本到临时文件夹。"""
+    # 需要导入 zipfile 和 tempfile
+    import zipfile
+    import tempfile
+
     update_dir = "update_temp"
     if not os.path.exists(update_dir):
         os.makedirs(update_dir)
@@ -185,14 +350,15 @@ def download_and_extract_update(version):
     try:
         zip_url = f"https://github.com/{GITHUB_REPO}/archive/refs/heads/main.zip"
         logger.info(f"正在从 {zip_url} 下载新版本...")
-        response = requests.get(zip_url, timeout=60)
-        response.raise_for_status()
-
-        # 需要导入 zipfile 和 io
-        import zipfile
-        import io
-        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            z.extractall(update_dir)
+        # 流式下载到可溢出到磁盘的临时文件，避免整个压缩包在内存中保存两份
+        with requests.get(zip_url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with tempfile.SpooledTemporaryFile(max_size=UPDATE_SPOOL_MAX_SIZE) as tmp:
+                for chunk in response.iter_content(chunk_size=UPDATE_DOWNLOAD_CHUNK_SIZE):
+                    tmp.write(chunk)
+                tmp.seek(0)
+                with zipfile.ZipFile(tmp) as z:
+                    z.extractall(update_dir)
         
         logger.info(f"新版本已成功下载并解压到 '{update_dir}' 文件夹。")
         return True
@@ -248,57 +414,41 @@ def check_for_updates():
 
     except requests.RequestException as e:
         logger.error(f"检查更新失败: {e}")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error("解析远程配置文件失败。")
     except Exception as e:
         logger.error(f"检查更新时发生未知错误: {e}")
 
 # --- 模型更新 ---
+_MODEL_ID_RE = re.compile(r'\{"id":"[a-f0-9-]+"')
+_JSON_DECODER = json.JSONDecoder()
+# 一次扫描同时还原 \" 与 \\，避免链式 replace 的多次全量拷贝及顺序问题
+_UNESCAPE_RE = re.compile(r'\\(["\\])')
+
 def extract_models_from_html(html_content):
     """
-    从 HTML 内容中提取完整的模型JSON对象，使用括号匹配确保完整性。
+    从 HTML 内容中提取完整的模型JSON对象。
+    先对整个页面做一次反转义，再由 JSONDecoder.raw_decode 从每个候选起点直接解析出完整对象。
     """
     models = []
     model_names = set()
-    
+
+    # 页面中的模型数据是被转义过的 JSON，整体反转义一次
+    unescaped = _UNESCAPE_RE.sub(r'\1', html_content)
+
     # 查找所有可能的模型JSON对象的起始位置
-    for start_match in re.finditer(r'\{\\"id\\":\\"[a-f0-9-]+\\"', html_content):
-        start_index = start_match.start()
-        
-        # 从起始位置开始，进行花括号匹配
-        open_braces = 0
-        end_index = -1
-        
-        # 优化：设置一个合理的搜索上限，避免无限循环
-        search_limit = start_index + 10000 # 假设一个模型定义不会超过10000个字符
-        
-        for i in range(start_index, min(len(html_content), search_limit)):
-            if html_content[i] == '{':
-                open_braces += 1
-            elif html_content[i] == '}':
-                open_braces -= 1
-                if open_braces == 0:
-                    end_index = i + 1
-                    break
-        
-        if end_index != -1:
-            # 提取完整的、转义的JSON字符串
-            json_string_escaped = html_content[start_index:end_index]
-            
-            # 反转义
-            json_string = json_string_escaped.replace('\\"', '"').replace('\\\\', '\\')
-            
-            try:
-                model_data = json.loads(json_string)
-                model_name = model_data.get('publicName')
-                
-                # 使用publicName去重
-                if model_name and model_name not in model_names:
-                    models.append(model_data)
-                    model_names.add(model_name)
-            except json.JSONDecodeError as e:
-                logger.warning(f"解析提取的JSON对象时出错: {e} - 内容: {json_string[:150]}...")
-                continue
+    for start_match in _MODEL_ID_RE.finditer(unescaped):
+        try:
+            model_data, _ = _JSON_DECODER.raw_decode(unescaped, start_match.start())
+        except json.JSONDecodeError as e:
+            logger.warning(f"解析提取的JSON对象时出错: {e} - 内容: {unescaped[start_match.start():start_match.start() + 150]}...")
+            continue
+
+        model_name = model_data.get('publicName')
+        # 使用publicName去重
+        if model_name and model_name not in model_names:
+            models.append(model_data)
+            model_names.add(model_name)
 
     if models:
         logger.info(f"成功提取并解析了 {len(models)} 个独立模型。")
@@ -322,69 +472,52 @@ def save_available_models(new_models_list, models_path="available_models.json"):
         logger.error(f"❌ 写入 '{models_path}' 文件时出错: {e}")
 
 # --- 自动重启逻辑 ---
-def restart_server():
+async def restart_server():
     """优雅地通知客户端刷新，然后重启服务器。"""
     logger.warning("="*60)
     logger.warning("检测到服务器空闲超时，准备自动重启...")
     logger.warning("="*60)
     
-    # 1. (异步) 通知浏览器刷新
-    async def notify_browser_refresh():
-        if browser_ws:
-            try:
-                # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("已向浏览器发送 'reconnect' 指令。")
-            except Exception as e:
-                logger.error(f"发送 'reconnect' 指令失败: {e}")
-    
-    # 在主事件循环中运行异步通知函数
-    # 使用`asyncio.run_coroutine_threadsafe`确保线程安全
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
-        asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
+    # 1. 通知浏览器刷新（与监控任务同处主事件循环，直接 await 即可）
+    if browser_ws and browser_ws.client_state.name == 'CONNECTED':
+        try:
+            # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
+            await browser_ws.send_text(_CMD_RECONNECT)
+            logger.info("已向浏览器发送 'reconnect' 指令。")
+        except Exception as e:
+            logger.error(f"发送 'reconnect' 指令失败: {e}")
     
     # 2. 延迟几秒以确保消息发送
-    time.sleep(3)
+    await asyncio.sleep(3)
     
     # 3. 执行重启
     logger.info("正在重启服务器...")
     os.execv(sys.executable, ['python'] + sys.argv)
 
-def idle_monitor():
-    """在后台线程中运行，监控服务器是否空闲。"""
-    global last_activity_time
-    
-    # 等待，直到 last_activity_time 被首次设置
-    while last_activity_time is None:
-        time.sleep(1)
-        
-    logger.info("空闲监控线程已启动。")
+async def idle_monitor():
+    """作为主事件循环中的后台任务运行，监控服务器是否空闲。"""
+    # lifespan 在创建本任务之前已设置 last_activity_time，无需再轮询等待
+    logger.info("空闲监控任务已启动。")
     
     while True:
-        if CONFIG.get("enable_idle_restart", False):
-            timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
-            
-            # 如果超时设置为-1，则禁用重启检查
-            if timeout == -1:
-                time.sleep(10) # 仍然需要休眠以避免繁忙循环
-                continue
-
-            idle_time = (datetime.now() - last_activity_time).total_seconds()
+        # 直接读取 load_config 时快照的阈值，循环中不再查询 CONFIG
+        timeout = IDLE_RESTART_TIMEOUT
+        if timeout is not None:
+            idle_time = time.monotonic() - last_activity_time
             
             if idle_time > timeout:
                 logger.info(f"服务器空闲时间 ({idle_time:.0f}s) 已超过阈值 ({timeout}s)。")
-                restart_server()
+                await restart_server()
                 break # 退出循环，因为进程即将被替换
                 
         # 每 10 秒检查一次
-        time.sleep(10)
+        await asyncio.sleep(10)
 
 # --- FastAPI 生命周期事件 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在服务器启动时运行的生命周期函数。"""
-    global idle_monitor_thread, last_activity_time, main_event_loop
-    main_event_loop = asyncio.get_running_loop() # 获取主事件循环
+    global idle_monitor_task, cf_refresher_task, last_activity_time
     load_config() # 首先加载配置
     
     # --- 打印当前的操作模式 ---
@@ -405,19 +538,32 @@ async def lifespan(app: FastAPI):
     # 检查并显示公告，放在启动信息的最后，使其更显眼
     check_and_display_announcement()
 
+    # 文件床启用时，提前预热到文件床的连接
+    if CONFIG.get("file_bed_enabled") and CONFIG.get("file_bed_upload_url"):
+        file_uploader.warm_up(CONFIG["file_bed_upload_url"].replace('\\/', '/'))
+
     # 在模型更新后，标记活动时间的起点
-    last_activity_time = datetime.now()
+    last_activity_time = time.monotonic()
     
-    # 启动空闲监控线程
+    # 启动空闲监控任务
     if CONFIG.get("enable_idle_restart", False):
-        idle_monitor_thread = threading.Thread(target=idle_monitor, daemon=True)
-        idle_monitor_thread.start()
-        
+        idle_monitor_task = asyncio.create_task(idle_monitor())
+
+    # 启动人机验证刷新指令发送任务
+    cf_refresher_task = asyncio.create_task(_cf_refresher())
 
     yield
+    # 取消后台任务并等待其真正结束
+    for task in (cf_refresher_task, idle_monitor_task):
+        if task:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    await file_uploader.aclose() # 关闭文件床共享的 HTTP 客户端
     logger.info("服务器正在关闭。")
 
-app = FastAPI(lifespan=lifespan)
+# 默认使用 orjson 序列化响应，跳过 jsonable_encoder 的逐项遍历
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- CORS 中间件配置 ---
 # 允许所有来源、所有方法、所有请求头，这对于本地开发工具是安全的。
@@ -430,36 +576,49 @@ app.add_middleware(
 )
 
 # --- 辅助函数 ---
+# 一次扫描同时定位 session_id 与 message_id 的值
+_CONFIG_ID_RE = re.compile(r'("(session_id|message_id)"\s*:\s*")[^"\n]*(")')
+
 def save_config():
     """将当前的 CONFIG 对象写回 config.jsonc 文件，保留注释。"""
     try:
-        # 读取原始文件以保留注释等
+        # 读取原始文件以保留注释等（id_updater.py 也会修改该文件，因此不使用缓存内容）
         with open('config.jsonc', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        # 使用正则表达式安全地替换值
-        def replacer(key, value, content):
-            # 这个正则表达式会找到 key，然后匹配它的 value 部分，直到逗号或右花括号
-            pattern = re.compile(rf'("{key}"\s*:\s*").*?("?)(,?\s*)$', re.MULTILINE)
-            replacement = rf'\g<1>{value}\g<2>\g<3>'
-            if not pattern.search(content): # 如果 key 不存在，就添加到文件末尾（简化处理）
-                 content = re.sub(r'}\s*$', f'  ,"{key}": "{value}"\n}}', content)
-            else:
-                 content = pattern.sub(replacement, content)
-            return content
+            content = f.read()
 
-        content_str = "".join(lines)
-        content_str = replacer("session_id", CONFIG["session_id"], content_str)
-        content_str = replacer("message_id", CONFIG["message_id"], content_str)
-        
-        with open('config.jsonc', 'w', encoding='utf-8') as f:
-            f.write(content_str)
+        found_keys = set()
+        def replacer(match):
+            key = match.group(2)
+            found_keys.add(key)
+            return f'{match.group(1)}{CONFIG[key]}{match.group(3)}'
+
+        content = _CONFIG_ID_RE.sub(replacer, content)
+        for key in ("session_id", "message_id"):
+            if key not in found_keys: # 如果 key 不存在，就添加到文件末尾（简化处理）
+                content = re.sub(r'}\s*$', f'  ,"{key}": "{CONFIG[key]}"\n}}', content)
+
+        # 先写临时文件再原子替换，避免写入中途出错导致配置文件损坏
+        tmp_path = 'config.jsonc.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, 'config.jsonc')
         logger.info("✅ 成功将会话信息更新到 config.jsonc。")
     except Exception as e:
         logger.error(f"❌ 写入 config.jsonc 时发生错误: {e}", exc_info=True)
 
 
-async def _process_openai_message(message: dict) -> dict:
+# mimetypes 的查询结果只取决于扩展名 / 类型本身，而实际出现的种类很少，缓存即可
+@lru_cache(maxsize=256)
+def _guess_content_type(extension: str) -> str:
+    """根据文件扩展名猜测 content_type。"""
+    return mimetypes.guess_type(f"file{extension}")[0] or 'application/octet-stream'
+
+@lru_cache(maxsize=256)
+def _guess_extension(content_type: str):
+    """根据 content_type 猜测文件扩展名。"""
+    return mimetypes.guess_extension(content_type)
+
+def _process_openai_message(message: dict) -> dict:
     """
     处理OpenAI消息，分离文本和附件。
     - 将多模态内容列表分解为纯文本和附件列表。
@@ -485,12 +644,12 @@ async def _process_openai_message(message: dict) -> dict:
                 try:
                     # 对于 base64，我们需要提取 content_type
                     if url.startswith("data:"):
-                        content_type = url.split(';')[0].split(':')[1]
+                        content_type, _ = split_data_uri(url)
                     else:
-                        # 对于 http URL，我们尝试猜测 content_type
-                        content_type = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+                        # 对于 http URL，我们尝试猜测 content_type（只看路径部分，忽略查询参数和片段）
+                        content_type = _guess_content_type(posixpath.splitext(urlsplit(url).path)[1])
 
-                    file_name = original_filename or f"image_{uuid.uuid4()}.{mimetypes.guess_extension(content_type).lstrip('.') or 'png'}"
+                    file_name = original_filename or f"image_{uuid.uuid4()}.{_guess_extension(content_type).lstrip('.') or 'png'}"
                     
                     attachments.append({
                         "name": file_name,
@@ -519,34 +678,27 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     将 OpenAI 请求体转换为油猴脚本所需的简化载荷，并应用酒馆模式、绕过模式以及对战模式。
     新增了模式覆盖参数，以支持模型特定的会话模式。
     """
-    # 1. 规范化角色并处理消息
+    # 1. 规范化角色并处理消息（单次遍历）
     #    - 将非标准的 'developer' 角色转换为 'system' 以提高兼容性。
     #    - 分离文本和附件。
-    messages = openai_data.get("messages", [])
-    for msg in messages:
+    #    - 酒馆模式 (Tavern Mode) 下同时收集系统提示词，其余消息按原顺序保留。
+    tavern_mode = CONFIG.get("tavern_mode_enabled")
+    system_prompts = []
+    message_templates = []
+    for msg in openai_data.get("messages", []):
         if msg.get("role") == "developer":
             msg["role"] = "system"
             logger.info("消息角色规范化：将 'developer' 转换为 'system'。")
-            
-    processed_messages = []
-    for msg in messages:
-        processed_msg = await _process_openai_message(msg.copy())
-        processed_messages.append(processed_msg)
-
-    # 2. 应用酒馆模式 (Tavern Mode)
-    if CONFIG.get("tavern_mode_enabled"):
-        system_prompts = [msg['content'] for msg in processed_messages if msg['role'] == 'system']
-        other_messages = [msg for msg in processed_messages if msg['role'] != 'system']
-        
-        merged_system_prompt = "\n\n".join(system_prompts)
-        final_messages = []
-        
-        if merged_system_prompt:
-            # 系统消息不应有附件
-            final_messages.append({"role": "system", "content": merged_system_prompt, "attachments": []})
-        
-        final_messages.extend(other_messages)
-        processed_messages = final_messages
+        # _process_openai_message 返回新建的 {role, content, attachments}，可直接作为消息模板
+        processed_msg = _process_openai_message(msg)
+        if tavern_mode and processed_msg["role"] == "system":
+            system_prompts.append(processed_msg["content"])
+        else:
+            message_templates.append(processed_msg)
+
+    # 2. 应用酒馆模式：合并后的系统消息放在最前，且不应有附件
+    if system_prompts and (merged_system_prompt := "\n\n".join(system_prompts)):
+        message_templates.insert(0, {"role": "system", "content": merged_system_prompt, "attachments": []})
 
     # 3. 确定目标模型 ID
     model_name = openai_data.get("model", "claude-3-5-sonnet-20241022")
@@ -561,15 +713,6 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     if not target_model_id:
         logger.warning(f"模型 '{model_name}' 在 'models.json' 中未找到对应的ID。请求将不带特定模型ID发送。")
 
-    # 4. 构建消息模板
-    message_templates = []
-    for msg in processed_messages:
-        message_templates.append({
-            "role": msg["role"],
-            "content": msg.get("content", ""),
-            "attachments": msg.get("attachments", [])
-        })
-    
     # 4.5. 特殊处理：如果用户消息结尾包含--bypass且包含图片，构造虚假助手消息
     if message_templates and message_templates[-1]["role"] == "user":
         last_msg = message_templates[-1]
@@ -647,31 +790,62 @@ async def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str,
     }
 
 # --- OpenAI 格式化辅助函数 (确保JSON序列化稳健) ---
-def format_openai_chunk(content: str, model: str, request_id: str) -> str:
+# 流式块按 token 调用，使用 orjson 直接产出 UTF-8 字节，StreamingResponse 无需再编码
+# SSE 帧的固定部分预先编码为字节常量
+_SSE_DATA = b"data: "
+_SSE_END = b"\n\n"
+_SSE_DONE = b"data: [DONE]\n\n"
+
+def format_openai_chunk(content: str, model: str, request_id: str, created: int | None = None) -> bytes:
     """格式化为 OpenAI 流式块。"""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
+        "created": created if created is not None else int(time.time()), "model": model,
         "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    return b"".join((_SSE_DATA, orjson.dumps(chunk), _SSE_END))
+
+_CONTENT_PLACEHOLDER = b'"content":""'
+
+def _split_at_content(frame: bytes) -> tuple[bytes, bytes]:
+    """
+    在预先序列化的 JSON 中空的 "content":"" 处拆分，返回 (prefix, suffix)。
+    prefix 以 "content": 结尾，suffix 紧跟在空字符串之后。
+    orjson 会转义字符串中的引号，未转义的 "content":"" 只可能是 content 字段本身。
+    """
+    split = frame.rindex(_CONTENT_PLACEHOLDER) + len(_CONTENT_PLACEHOLDER) - 2
+    return frame[:split], frame[split + 2:]
 
-def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
+def make_openai_chunk_template(model: str, request_id: str, created: int) -> tuple[bytes, bytes]:
+    """
+    预先序列化一个流中所有内容块共享的外壳，返回 (prefix, suffix)。
+    id / model / created 在整个流中不变，之后每个块只需序列化 delta.content。
+    """
+    return _split_at_content(format_openai_chunk("", model, request_id, created))
+
+def format_openai_chunk_from_template(template: tuple[bytes, bytes], content: str) -> bytes:
+    """使用 make_openai_chunk_template 生成的外壳格式化流式块。"""
+    prefix, suffix = template
+    return b"".join((prefix, orjson.dumps(content), suffix))
+
+def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop', created: int | None = None) -> bytes:
     """格式化为 OpenAI 结束块。"""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
+        "created": created if created is not None else int(time.time()), "model": model,
         "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
     }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
+    return b"".join((_SSE_DATA, orjson.dumps(chunk), _SSE_END, _SSE_DONE))
 
-def format_openai_error_chunk(error_message: str, model: str, request_id: str) -> str:
+def format_openai_error_chunk(error_message: str, model: str, request_id: str, created: int | None = None) -> bytes:
     """格式化为 OpenAI 错误块。"""
     content = f"\n\n[LMArena Bridge Error]: {error_message}"
-    return format_openai_chunk(content, model, request_id)
+    return format_openai_chunk(content, model, request_id, created)
 
-def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
-    """构建符合 OpenAI 规范的非流式响应体。"""
+def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop', content_length: int | None = None) -> dict:
+    """构建符合 OpenAI 规范的非流式响应体。content_length 用于 content 稍后再拼接的场景。"""
+    if content_length is None:
+        content_length = len(content)
     return {
         "id": request_id,
         "object": "chat.completion",
@@ -684,11 +858,59 @@ def format_openai_non_stream_response(content: str, model: str, request_id: str,
         }],
         "usage": {
             "prompt_tokens": 0,
-            "completion_tokens": len(content) // 4,
-            "total_tokens": len(content) // 4,
+            "completion_tokens": content_length // 4,
+            "total_tokens": content_length // 4,
         },
     }
 
+# --- LMArena 流解析所用的正则表达式（模块级预编译） ---
+_TEXT_RE = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
+# 用于匹配和提取图片URL的正则表达式
+_IMAGE_RE = re.compile(r'[ab]2:(\[.*?\])')
+_FINISH_RE = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
+# 只定位错误对象的起点，完整对象交给 JSONDecoder.raw_decode 做括号匹配
+_ERROR_START_RE = re.compile(r'\{\s*"error"')
+# Cloudflare 人机验证页面特征，合并为一个正则，一次扫描即可完成检测
+_CLOUDFLARE_PATTERNS = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+_CF_RE = re.compile('|'.join(_CLOUDFLARE_PATTERNS), re.IGNORECASE)
+# 流缓冲区中已消费的前缀超过该长度时才真正截断
+_STREAM_BUFFER_COMPACT_THRESHOLD = 64 * 1024
+
+# --- Cloudflare 人机验证处理 ---
+# 刷新指令由常驻的 _cf_refresher 任务发送，检测路径上只需设置事件，无需每次创建新任务
+_cf_refresh_event = asyncio.Event()
+
+async def _cf_refresher():
+    """常驻任务：等待刷新信号，并向油猴脚本发送刷新指令。"""
+    while True:
+        await _cf_refresh_event.wait()
+        _cf_refresh_event.clear()
+        if browser_ws:
+            try:
+                await browser_ws.send_text(_CMD_REFRESH)
+            except Exception as e:
+                logger.error(f"发送 'refresh' 指令失败: {e}")
+
+def _handle_cloudflare_verification(request_id: str) -> str:
+    """处理检测到的人机验证，返回给客户端的提示信息。"""
+    global IS_REFRESHING_FOR_VERIFICATION
+    if not IS_REFRESHING_FOR_VERIFICATION:
+        logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 首次检测到人机验证，将发送刷新指令。")
+        IS_REFRESHING_FOR_VERIFICATION = True
+        _cf_refresh_event.set()
+        return "检测到人机验证，已发送刷新指令，请稍后重试。"
+    else:
+        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 检测到人机验证，但已在刷新中，将等待。")
+        return "正在等待人机验证完成..."
+
+def _is_stream_chunk(raw_data) -> bool:
+    """判断浏览器消息是否为普通数据块（而非错误字典或 [DONE] 信号）。"""
+    return isinstance(raw_data, list) or (isinstance(raw_data, str) and raw_data != "[DONE]")
+
+def _stream_chunk_text(raw_data) -> str:
+    """将浏览器发来的数据块统一转换为字符串。"""
+    return "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+
 async def _process_lmarena_stream(request_id: str):
     """
     核心内部生成器：处理来自浏览器的原始数据流，并产生结构化事件。
@@ -702,37 +924,37 @@ async def _process_lmarena_stream(request_id: str):
         return
 
     buffer = ""
+    cursor = 0 # 已消费位置；用游标代替反复切片，避免长响应下的平方级拷贝
     timeout = CONFIG.get("stream_response_timeout_seconds",360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    # 新增：用于匹配和提取图片URL的正则表达式
-    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
-    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
-    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
-    
+
     has_yielded_content = False # 标记是否已产出过有效内容
+    pending = None # 合并数据块时遇到的控制消息（错误 / [DONE]），留到下一轮处理
 
     try:
         while True:
-            try:
-                raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
-            except asyncio.TimeoutError:
-                logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
-                yield 'error', f'Response timed out after {timeout} seconds.'
-                return
+            if pending is not None:
+                raw_data, pending = pending, None
+            else:
+                try:
+                    raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
+                    yield 'error', f'Response timed out after {timeout} seconds.'
+                    return
 
-            # --- Cloudflare 人机验证处理 ---
-            def handle_cloudflare_verification():
-                global IS_REFRESHING_FOR_VERIFICATION
-                if not IS_REFRESHING_FOR_VERIFICATION:
-                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 首次检测到人机验证，将发送刷新指令。")
-                    IS_REFRESHING_FOR_VERIFICATION = True
-                    if browser_ws:
-                        asyncio.create_task(browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False)))
-                    return "检测到人机验证，已发送刷新指令，请稍后重试。"
-                else:
-                    logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 检测到人机验证，但已在刷新中，将等待。")
-                    return "正在等待人机验证完成..."
+            # 将队列中已就绪的数据块一次性取出并合并，减少事件循环往返和正则扫描次数
+            if _is_stream_chunk(raw_data):
+                parts = [_stream_chunk_text(raw_data)]
+                while True:
+                    try:
+                        next_data = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if not _is_stream_chunk(next_data):
+                        pending = next_data
+                        break
+                    parts.append(_stream_chunk_text(next_data))
+                raw_data = "".join(parts)
 
             # 1. 检查来自 WebSocket 端的直接错误
             if isinstance(raw_data, dict) and 'error' in raw_data:
@@ -743,8 +965,8 @@ async def _process_lmarena_stream(request_id: str):
                         logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 检测到附件过大错误 (413)。")
                         yield 'error', friendly_error_msg
                         return
-                    if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
-                        yield 'error', handle_cloudflare_verification()
+                    if _CF_RE.search(error_msg):
+                        yield 'error', _handle_cloudflare_verification(request_id)
                         return
                 yield 'error', error_msg
                 return
@@ -757,125 +979,203 @@ async def _process_lmarena_stream(request_id: str):
                 break
 
             # 3. 累加缓冲区并检查内容
-            buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+            buffer += raw_data
 
-            if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
-                yield 'error', handle_cloudflare_verification()
+            if _CF_RE.search(buffer, cursor):
+                yield 'error', _handle_cloudflare_verification(request_id)
                 return
             
-            if (error_match := error_pattern.search(buffer)):
+            if (error_match := _ERROR_START_RE.search(buffer, cursor)):
                 try:
-                    error_json = json.loads(error_match.group(1))
+                    error_json, _ = _JSON_DECODER.raw_decode(buffer, error_match.start())
                     yield 'error', error_json.get("error", "来自 LMArena 的未知错误")
                     return
                 except json.JSONDecodeError: pass
 
             # 优先处理文本内容
-            while (match := text_pattern.search(buffer)):
+            while (match := _TEXT_RE.search(buffer, cursor)):
                 try:
-                    text_content = json.loads(f'"{match.group(1)}"')
+                    text_content = match.group(1)
+                    # 绝大多数 token 不含转义序列，可直接使用；否则交给 orjson 还原转义
+                    if '\\' in text_content:
+                        text_content = orjson.loads(f'"{text_content}"')
                     if text_content:
                         has_yielded_content = True
                         yield 'content', text_content
-                except (ValueError, json.JSONDecodeError): pass
-                buffer = buffer[match.end():]
+                except ValueError: pass # 包括 orjson.JSONDecodeError
+                cursor = match.end()
 
             # 新增：处理图片内容
-            while (match := image_pattern.search(buffer)):
+            while (match := _IMAGE_RE.search(buffer, cursor)):
                 try:
-                    image_data_list = json.loads(match.group(1))
+                    image_data_list = orjson.loads(match.group(1))
                     if isinstance(image_data_list, list) and image_data_list:
                         image_info = image_data_list[0]
                         if image_info.get("type") == "image" and "image" in image_info:
                             # 将URL包装成Markdown格式并作为内容块yield
                             markdown_image = f"![Image]({image_info['image']})"
                             yield 'content', markdown_image
-                except (json.JSONDecodeError, IndexError) as e:
-                    logger.warning(f"解析图片URL时出错: {e}, buffer: {buffer[:150]}")
-                buffer = buffer[match.end():]
+                except (orjson.JSONDecodeError, IndexError) as e:
+                    logger.warning(f"解析图片URL时出错: {e}, buffer: {buffer[cursor:cursor + 150]}")
+                cursor = match.end()
 
-            if (finish_match := finish_pattern.search(buffer)):
+            if (finish_match := _FINISH_RE.search(buffer, cursor)):
                 try:
-                    finish_data = json.loads(finish_match.group(1))
+                    finish_data = orjson.loads(finish_match.group(1))
                     yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError): pass
-                buffer = buffer[finish_match.end():]
+                except (orjson.JSONDecodeError, IndexError): pass
+                cursor = finish_match.end()
+
+            # 已消费部分足够大时才压缩缓冲区，摊还切片开销
+            if cursor > _STREAM_BUFFER_COMPACT_THRESHOLD:
+                buffer = buffer[cursor:]
+                cursor = 0
 
     except asyncio.CancelledError:
         logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 任务被取消。")
     finally:
-        if request_id in response_channels:
-            del response_channels[request_id]
+        if _close_channel(request_id):
             logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 响应通道已清理。")
 
+# 上游因内容审查 (content-filter) 结束时，追加在回复末尾的提示
+_CONTENT_FILTER_WARNING = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
+
 async def stream_generator(request_id: str, model: str):
     """将内部事件流格式化为 OpenAI SSE 响应。"""
     response_id = f"chatcmpl-{uuid.uuid4()}"
+    created = int(time.time()) # 同一个流的所有块共用同一个时间戳
+    chunk_template = make_openai_chunk_template(model, response_id, created)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器启动。")
     
     finish_reason_to_send = 'stop'  # 默认的结束原因
 
     async for event_type, data in _process_lmarena_stream(request_id):
         if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
+            yield format_openai_chunk_from_template(chunk_template, data)
         elif event_type == 'finish':
             # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
             finish_reason_to_send = data
             if data == 'content-filter':
-                warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
-                yield format_openai_chunk(warning_msg, model, response_id)
+                yield format_openai_chunk_from_template(chunk_template, _CONTENT_FILTER_WARNING)
         elif event_type == 'error':
             logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
+            yield format_openai_error_chunk(str(data), model, response_id, created)
+            yield format_openai_finish_chunk(model, response_id, reason='stop', created=created)
             return # 发生错误时，可以立即终止
 
     # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
+    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send, created=created)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
 
+def _non_stream_error_response(request_id: str, data) -> Response:
+    """构建非流式请求的错误响应。"""
+    logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
+    
+    # 统一流式和非流式响应的错误状态码
+    status_code = 413 if "附件大小超过了" in str(data) else 500
+
+    error_response = {
+        "error": {
+            "message": f"[LMArena Bridge Error]: {data}",
+            "type": "bridge_error",
+            "code": "attachment_too_large" if status_code == 413 else "processing_error"
+        }
+    }
+    return Response(content=orjson.dumps(error_response), status_code=status_code, media_type="application/json")
+
 async def non_stream_response(request_id: str, model: str):
     """聚合内部事件流并返回单个 OpenAI JSON 响应。"""
+    if CONFIG.get("non_stream_incremental_body", False):
+        return await incremental_non_stream_response(request_id, model)
+
     response_id = f"chatcmpl-{uuid.uuid4()}"
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 开始处理非流式响应。")
     
-    full_content = []
+    # 内容以 JSON 转义后的 UTF-8 字节（不含首尾引号）累积，最后直接拼入响应体，
+    # 避免先拼接出完整的 str 再整体编码一次
+    full_content = bytearray()
+    content_length = 0
     finish_reason = "stop"
     
     async for event_type, data in _process_lmarena_stream(request_id):
         if event_type == 'content':
-            full_content.append(data)
+            full_content += orjson.dumps(data)[1:-1]
+            content_length += len(data)
         elif event_type == 'finish':
             finish_reason = data
             if data == 'content-filter':
-                full_content.append("\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因")
+                full_content += orjson.dumps(_CONTENT_FILTER_WARNING)[1:-1]
+                content_length += len(_CONTENT_FILTER_WARNING)
             # 不要在这里 break，继续等待来自浏览器的 [DONE] 信号，以避免竞态条件
         elif event_type == 'error':
-            logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
-            
-            # 统一流式和非流式响应的错误状态码
-            status_code = 413 if "附件大小超过了" in str(data) else 500
-
-            error_response = {
-                "error": {
-                    "message": f"[LMArena Bridge Error]: {data}",
-                    "type": "bridge_error",
-                    "code": "attachment_too_large" if status_code == 413 else "processing_error"
-                }
-            }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+            return _non_stream_error_response(request_id, data)
 
-    final_content = "".join(full_content)
-    response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
+    response_data = format_openai_non_stream_response("", model, response_id, reason=finish_reason, content_length=content_length)
+    prefix, suffix = _split_at_content(orjson.dumps(response_data))
     
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 响应聚合完成。")
-    return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
+    return Response(content=b"".join((prefix, b'"', full_content, b'"', suffix)), media_type="application/json")
+
+async def incremental_non_stream_response(request_id: str, model: str):
+    """
+    以分块传输的方式返回非流式 OpenAI JSON 响应。
+    响应体仍是一个完整的 JSON 对象，但 content 随收到的内容逐段写出，
+    服务器无需缓存全部输出，首字节时间也与首个 token 相同。
+    """
+    response_id = f"chatcmpl-{uuid.uuid4()}"
+    logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 开始处理非流式响应（增量响应体）。")
+    events = _process_lmarena_stream(request_id)
+
+    # 先取第一个事件：若一开始就出错（如附件过大、人机验证），仍返回带相应状态码的错误响应
+    first_event = await anext(events, None)
+    if first_event is not None and first_event[0] == 'error':
+        await events.aclose()
+        return _non_stream_error_response(request_id, first_event[1])
+
+    async def body():
+        # created 等字段位于 content 之前，finish_reason 与 usage 位于其后，待内容结束后再生成
+        prefix, _ = _split_at_content(orjson.dumps(format_openai_non_stream_response("", model, response_id)))
+        yield prefix + b'"'
+
+        content_length = 0
+        finish_reason = "stop"
+        event = first_event
+        try:
+            while event is not None:
+                event_type, data = event
+                if event_type == 'content':
+                    yield orjson.dumps(data)[1:-1]
+                    content_length += len(data)
+                elif event_type == 'finish':
+                    finish_reason = data
+                    if data == 'content-filter':
+                        yield orjson.dumps(_CONTENT_FILTER_WARNING)[1:-1]
+                        content_length += len(_CONTENT_FILTER_WARNING)
+                elif event_type == 'error':
+                    # 状态码已发出，与流式响应一致，把错误信息追加到内容末尾
+                    logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
+                    error_note = f"\n\n[LMArena Bridge Error]: {data}"
+                    yield orjson.dumps(error_note)[1:-1]
+                    content_length += len(error_note)
+                    finish_reason = "stop"
+                    break
+                event = await anext(events, None)
+        finally:
+            # 客户端提前断开时也要关闭内部事件流，以便及时清理响应通道
+            await events.aclose()
+
+        response_data = format_openai_non_stream_response("", model, response_id, reason=finish_reason, content_length=content_length)
+        _, suffix = _split_at_content(orjson.dumps(response_data))
+        yield b'"' + suffix
+        logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 响应发送完成。")
+
+    return StreamingResponse(body(), media_type="application/json")
 
 # --- WebSocket 端点 ---
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """处理来自油猴脚本的 WebSocket 连接。"""
-    global browser_ws, IS_REFRESHING_FOR_VERIFICATION
+    global browser_ws, browser_ws_binary, IS_REFRESHING_FOR_VERIFICATION
     await websocket.accept()
     if browser_ws is not None:
         logger.warning("检测到新的油猴脚本连接，旧的连接将被替换。")
@@ -885,13 +1185,24 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.info("✅ 新的 WebSocket 连接已建立，人机验证状态已自动重置。")
         IS_REFRESHING_FOR_VERIFICATION = False
         
-    logger.info("✅ 油猴脚本已成功连接 WebSocket。")
+    browser_ws_binary = websocket.query_params.get("binary") == "1"
+    if browser_ws_binary:
+        logger.info("✅ 油猴脚本已成功连接 WebSocket。")
+    else:
+        logger.warning("⚠️ 油猴脚本已连接 WebSocket，但脚本版本较旧（不支持二进制帧），请重新安装最新的 LMArenaApiBridge.js。")
     browser_ws = websocket
+    channels = response_channels  # 局部别名，避免消息循环中反复查找全局变量
     try:
         while True:
-            # 等待并接收来自油猴脚本的消息
-            message_str = await websocket.receive_text()
-            message = json.loads(message_str)
+            # 等待并接收来自油猴脚本的消息。新版脚本发送二进制帧，
+            # orjson 可直接解析 UTF-8 字节；旧版脚本发送的文本帧同样兼容。
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            payload = frame.get("bytes")
+            if payload is None:
+                payload = frame.get("text")
+            message = orjson.loads(payload)
             
             request_id = message.get("request_id")
             data = message.get("data")
@@ -901,8 +1212,13 @@ async def websocket_endpoint(websocket: WebSocket):
                 continue
 
             # 将收到的数据放入对应的响应通道
-            if request_id in response_channels:
-                await response_channels[request_id].put(data)
+            # 通道已满时在此等待（背压），期间暂停接收浏览器的后续消息
+            channel = channels.get(request_id)
+            if channel is not None:
+                if not await channel.put(data, RESPONSE_CHANNEL_PUT_TIMEOUT) and channels.get(request_id) is channel:
+                    logger.warning(f"⚠️ 请求 {request_id[:8]} 的响应通道已满且超过 {RESPONSE_CHANNEL_PUT_TIMEOUT} 秒未被读取，放弃该请求。")
+                    channel.put_nowait({"error": "Response channel overflow: client stopped reading"})
+                    _close_channel(request_id)
             else:
                 logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
 
@@ -912,10 +1228,13 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"WebSocket 处理时发生未知错误: {e}", exc_info=True)
     finally:
         browser_ws = None
-        # 清理所有等待的响应通道，以防请求被挂起
-        for queue in response_channels.values():
-            await queue.put({"error": "Browser disconnected during operation"})
-        response_channels.clear()
+        browser_ws_binary = False
+        # 清理所有等待的响应通道，以防请求被挂起。
+        # 错误消息经 put_nowait 写入，不受通道容量限制，一次遍历即可唤醒全部等待者。
+        disconnect_error = {"error": "Browser disconnected during operation"}
+        for queue in channels.values():
+            queue.put_nowait(disconnect_error)
+        channels.clear()
         logger.info("WebSocket 连接已清理。")
 
 # --- OpenAI 兼容 API 端点 ---
@@ -923,23 +1242,13 @@ async def websocket_endpoint(websocket: WebSocket):
 async def get_models():
     """提供兼容 OpenAI 的模型列表。"""
     if not MODEL_NAME_TO_ID_MAP:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404,
             content={"error": "模型列表为空或 'models.json' 未找到。"}
         )
     
-    return {
-        "object": "list",
-        "data": [
-            {
-                "id": model_name, 
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "LMArenaBridge"
-            }
-            for model_name in MODEL_NAME_TO_ID_MAP.keys()
-        ],
-    }
+    # 直接返回 load_model_map 时预先序列化好的响应体
+    return Response(content=MODELS_RESPONSE_BYTES, media_type="application/json")
 
 @app.post("/internal/request_model_update")
 async def request_model_update():
@@ -953,9 +1262,9 @@ async def request_model_update():
     
     try:
         logger.info("MODEL UPDATE: 收到更新请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "send_page_source"}))
+        await browser_ws.send_text(_CMD_SEND_PAGE_SOURCE)
         logger.info("MODEL UPDATE: 'send_page_source' 指令已成功发送。")
-        return JSONResponse({"status": "success", "message": "Request to send page source sent."})
+        return ORJSONResponse({"status": "success", "message": "Request to send page source sent."})
     except Exception as e:
         logger.error(f"MODEL UPDATE: 发送指令时出错: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Failed to send command via WebSocket.")
@@ -968,7 +1277,7 @@ async def update_available_models_endpoint(request: Request):
     html_content = await request.body()
     if not html_content:
         logger.warning("模型更新请求未收到任何 HTML 内容。")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status": "error", "message": "No HTML content received."}
         )
@@ -978,15 +1287,39 @@ async def update_available_models_endpoint(request: Request):
     
     if new_models_list:
         save_available_models(new_models_list)
-        return JSONResponse({"status": "success", "message": "Available models file updated."})
+        return ORJSONResponse({"status": "success", "message": "Available models file updated."})
     else:
         logger.error("未能从油猴脚本提供的 HTML 中提取模型数据。")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status": "error", "message": "Could not extract model data from HTML."}
         )
 
 
+async def _upload_image_part(part: dict, upload_url: str, api_key: str | None, presigned: bool):
+    """将单个 image_url 附件上传到文件床，并把其 URL 原地替换为文件床地址。"""
+    image_url_data = part["image_url"]
+    base64_url = image_url_data["url"]
+    file_name = image_url_data.get("detail") or f"image_{uuid.uuid4()}.png"
+
+    logger.info(f"文件床预处理：正在上传 '{file_name}'...")
+    # 只解析头部，base64 载荷在上传时按块边解码边发送
+    media_type, payload_start = split_data_uri(base64_url)
+    payload_b64 = memoryview(base64_url.encode("ascii"))[payload_start:]
+    uploaded_filename, upload_error, error_message = await upload_base64_to_file_bed(
+        file_name, media_type, payload_b64, upload_url, api_key, presigned=presigned,
+    )
+
+    if upload_error:
+        raise IOError(f"文件床上传失败 ({upload_error.value}): {error_message}")
+
+    # 根据您的建议，使用 config 中的 URL 前缀构建最终 URL
+    url_prefix = upload_url.rsplit('/', 1)[0]
+    final_url = f"{url_prefix}/uploads/{uploaded_filename}"
+
+    image_url_data["url"] = final_url
+    logger.info(f"附件URL已成功替换为: {final_url}")
+
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """
@@ -995,20 +1328,20 @@ async def chat_completions(request: Request):
     通过 WebSocket 发送给油猴脚本，然后流式返回结果。
     """
     global last_activity_time
-    last_activity_time = datetime.now() # 更新活动时间
-    logger.info(f"API请求已收到，活动时间已更新为: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    last_activity_time = time.monotonic() # 更新活动时间
+    logger.info(f"API请求已收到，活动时间已更新为: {time.strftime('%Y-%m-%d %H:%M:%S')}")
 
+    raw_body = await request.body()
     try:
-        openai_req = await request.json()
-    except json.JSONDecodeError:
+        openai_req = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
 
     model_name = openai_req.get("model")
-    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {}) # 关键修复：如果模型未找到，返回一个空字典而不是None
-    model_type = model_info.get("type", "text") # 默认为 text
+    is_image = model_name in IMAGE_MODEL_NAMES # 模型类型已在加载 models.json 时预先分类
 
     # --- 新增：基于模型类型的判断逻辑 ---
-    if model_type == 'image':
+    if is_image:
         logger.info(f"检测到模型 '{model_name}' 类型为 'image'，将通过主聊天接口处理。")
         # 对于图像模型，我们不再调用独立的处理器，而是复用主聊天逻辑，
         # 因为 _process_lmarena_stream 现在已经能处理图片数据。
@@ -1049,41 +1382,33 @@ async def chat_completions(request: Request):
         )
 
     # --- 模型与会话ID映射逻辑 ---
-    session_id, message_id = None, None
-    mode_override, battle_target_override = None, None
-
-    if model_name and model_name in MODEL_ENDPOINT_MAP:
-        mapping_entry = MODEL_ENDPOINT_MAP[model_name]
-        selected_mapping = None
-
-        if isinstance(mapping_entry, list) and mapping_entry:
-            selected_mapping = random.choice(mapping_entry)
+    # 端点元组已在加载映射/配置时预先规整，这里只需选择并解包
+    session_id = None
+    candidates = _ENDPOINT_CANDIDATES.get(model_name)
+
+    if candidates is not None:
+        is_list, endpoints = candidates
+        if is_list:
+            endpoint = random.choice(endpoints)
             logger.info(f"为模型 '{model_name}' 从ID列表中随机选择了一个映射。")
-        elif isinstance(mapping_entry, dict):
-            selected_mapping = mapping_entry
+        else:
+            endpoint = endpoints[0]
             logger.info(f"为模型 '{model_name}' 找到了单个端点映射（旧格式）。")
-        
-        if selected_mapping:
-            session_id = selected_mapping.get("session_id")
-            message_id = selected_mapping.get("message_id")
-            # 关键：同时获取模式信息
-            mode_override = selected_mapping.get("mode") # 可能为 None
-            battle_target_override = selected_mapping.get("battle_target") # 可能为 None
-            log_msg = f"将使用 Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
-            if mode_override:
-                log_msg += f" (模式: {mode_override}"
-                if mode_override == 'battle':
-                    log_msg += f", 目标: {battle_target_override or 'A'}"
-                log_msg += ")"
-            logger.info(log_msg)
+        # 关键：同时获取模式信息（mode / battle_target 可能为 None）
+        session_id, message_id, mode_override, battle_target_override, ids_valid = endpoint
+        log_msg = f"将使用 Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
+        if mode_override:
+            log_msg += f" (模式: {mode_override}"
+            if mode_override == 'battle':
+                log_msg += f", 目标: {battle_target_override or 'A'}"
+            log_msg += ")"
+        logger.info(log_msg)
 
     # 如果经过以上处理，session_id 仍然是 None，则进入全局回退逻辑
     if not session_id:
         if CONFIG.get("use_default_ids_if_mapping_not_found", True):
-            session_id = CONFIG.get("session_id")
-            message_id = CONFIG.get("message_id")
             # 当使用全局ID时，不设置模式覆盖，让其使用全局配置
-            mode_override, battle_target_override = None, None
+            session_id, message_id, mode_override, battle_target_override, ids_valid = _DEFAULT_ENDPOINT
             logger.info(f"模型 '{model_name}' 未找到有效映射，根据配置使用全局默认 Session ID: ...{session_id[-6:] if session_id else 'N/A'}")
         else:
             logger.error(f"模型 '{model_name}' 未在 'model_endpoint_map.json' 中找到有效映射，且已禁用回退到默认ID。")
@@ -1093,57 +1418,57 @@ async def chat_completions(request: Request):
             )
 
     # --- 验证最终确定的会话信息 ---
-    if not session_id or not message_id or "YOUR_" in session_id or "YOUR_" in message_id:
-        raise HTTPException(
-            status_code=400,
-            detail="最终确定的会话ID或消息ID无效。请检查 'model_endpoint_map.json' 和 'config.jsonc' 中的配置，或运行 `id_updater.py` 来更新默认值。"
-        )
+    if not ids_valid:
+        raise HTTPException(status_code=400, detail=_INVALID_IDS_DETAIL)
 
     if not model_name or model_name not in MODEL_NAME_TO_ID_MAP:
         logger.warning(f"请求的模型 '{model_name}' 不在 models.json 中，将使用默认模型ID。")
 
     request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
+    response_channels[request_id] = _Channel(RESPONSE_CHANNEL_MAXSIZE)
     logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道。")
 
     try:
         # --- 附件预处理（包括文件床上传） ---
         # 在与浏览器通信前，先处理好所有附件。如果失败，则立即返回错误。
-        messages_to_process = openai_req.get("messages", [])
+        # 只有启用文件床且原始请求体中确实出现 "image_url" 时才需要遍历所有消息，
+        # 纯文本请求直接跳过这一轮扫描
+        if CONFIG.get("file_bed_enabled") and b'"image_url"' in raw_body:
+            messages_to_process = openai_req.get("messages", [])
+        else:
+            messages_to_process = []
+        image_parts = []
         for message in messages_to_process:
             content = message.get("content")
             if isinstance(content, list):
-                for i, part in enumerate(content):
-                    if part.get("type") == "image_url" and CONFIG.get("file_bed_enabled"):
-                        image_url_data = part.get("image_url", {})
-                        base64_url = image_url_data.get("url")
-                        original_filename = image_url_data.get("detail")
-                        
+                for part in content:
+                    if part.get("type") == "image_url":
+                        base64_url = part.get("image_url", {}).get("url")
                         if not (base64_url and base64_url.startswith("data:")):
                             raise ValueError(f"无效的图片数据格式: {base64_url[:100] if base64_url else 'None'}")
-
-                        upload_url = CONFIG.get("file_bed_upload_url")
-                        if not upload_url:
-                            raise ValueError("文件床已启用，但 'file_bed_upload_url' 未配置。")
-                        
-                        # 确保处理转义的斜杠
-                        upload_url = upload_url.replace('\\/', '/')
-
-                        api_key = CONFIG.get("file_bed_api_key")
-                        file_name = original_filename or f"image_{uuid.uuid4()}.png"
-                        
-                        logger.info(f"文件床预处理：正在上传 '{file_name}'...")
-                        uploaded_filename, error_message = await upload_to_file_bed(file_name, base64_url, upload_url, api_key)
-
-                        if error_message:
-                            raise IOError(f"文件床上传失败: {error_message}")
-                        
-                        # 根据您的建议，使用 config 中的 URL 前缀构建最终 URL
-                        url_prefix = upload_url.rsplit('/', 1)[0]
-                        final_url = f"{url_prefix}/uploads/{uploaded_filename}"
-                        
-                        part["image_url"]["url"] = final_url
-                        logger.info(f"附件URL已成功替换为: {final_url}")
+                        image_parts.append(part)
+
+        if image_parts:
+            upload_url = CONFIG.get("file_bed_upload_url")
+            if not upload_url:
+                raise ValueError("文件床已启用，但 'file_bed_upload_url' 未配置。")
+            # 确保处理转义的斜杠
+            upload_url = upload_url.replace('\\/', '/')
+            api_key = CONFIG.get("file_bed_api_key")
+            presigned = CONFIG.get("file_bed_use_presigned_url", False)
+            # 同一请求中的多个附件并发上传，共享连接池，并发上限由 file_uploader 的信号量控制
+            upload_tasks = [
+                asyncio.create_task(_upload_image_part(part, upload_url, api_key, presigned))
+                for part in image_parts
+            ]
+            try:
+                await asyncio.gather(*upload_tasks)
+            except BaseException:
+                # 任一附件失败（或请求被取消）时，取消其余仍在进行的上传，不再占用文件床和连接池
+                for task in upload_tasks:
+                    task.cancel()
+                await asyncio.gather(*upload_tasks, return_exceptions=True)
+                raise
 
         # 1. 转换请求 (此时已不包含需要上传的附件)
         lmarena_payload = await convert_openai_to_lmarena_payload(
@@ -1155,18 +1480,22 @@ async def chat_completions(request: Request):
         )
         
         # 关键补充：如果模型是图片类型，则向油猴脚本明确指出
-        if model_type == 'image':
+        if is_image:
             lmarena_payload['is_image_request'] = True
         
-        # 2. 包装成发送给浏览器的消息
-        message_to_browser = {
-            "request_id": request_id,
-            "payload": lmarena_payload
-        }
+        # 2. 包装成发送给浏览器的消息：request_id 是 uuid，无需转义，
+        #    直接把载荷的序列化结果拼进外层信封，省去包装字典和二次编码
+        message_to_browser = b''.join((
+            b'{"request_id":"', request_id.encode(), b'","payload":',
+            orjson.dumps(lmarena_payload), b'}',
+        ))
         
-        # 3. 通过 WebSocket 发送
+        # 3. 通过 WebSocket 发送：新版脚本以二进制帧接收，旧版脚本只能解析文本帧
         logger.info(f"API CALL [ID: {request_id[:8]}]: 正在通过 WebSocket 发送载荷到油猴脚本。")
-        await browser_ws.send_text(json.dumps(message_to_browser))
+        if browser_ws_binary:
+            await browser_ws.send_bytes(message_to_browser)
+        else:
+            await browser_ws.send_text(message_to_browser.decode())
 
         # 4. 根据 stream 参数决定返回类型
         is_stream = openai_req.get("stream", False)
@@ -1183,20 +1512,18 @@ async def chat_completions(request: Request):
     except (ValueError, IOError) as e:
         # 捕获附件处理错误
         logger.error(f"API CALL [ID: {request_id[:8]}]: 附件预处理失败: {e}")
-        if request_id in response_channels:
-            del response_channels[request_id]
+        _close_channel(request_id)
         # 返回一个格式正确的JSON错误响应
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": {"message": f"[LMArena Bridge Error] 附件处理失败: {e}", "type": "attachment_error"}}
         )
     except Exception as e:
         # 捕获所有其他错误
-        if request_id in response_channels:
-            del response_channels[request_id]
+        _close_channel(request_id)
         logger.error(f"API CALL [ID: {request_id[:8]}]: 处理请求时发生致命错误: {e}", exc_info=True)
         # 确保也返回格式正确的JSON
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"error": {"message": str(e), "type": "internal_server_error"}}
         )
@@ -1214,9 +1541,9 @@ async def start_id_capture():
     
     try:
         logger.info("ID CAPTURE: 收到激活请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
+        await browser_ws.send_text(_CMD_ACTIVATE_ID_CAPTURE)
         logger.info("ID CAPTURE: 激活指令已成功发送。")
-        return JSONResponse({"status": "success", "message": "Activation command sent."})
+        return ORJSONResponse({"status": "success", "message": "Activation command sent."})
     except Exception as e:
         logger.error(f"ID CAPTURE: 发送激活指令时出错: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Failed to send command via WebSocket.")
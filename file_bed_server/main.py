@@ -1,16 +1,25 @@
 # file_bed_server/main.py
+import asyncio
 import base64
+import contextlib
+import hashlib
+import hmac
+import mimetypes
 import os
+import re
+import secrets
+import shutil
 import uuid
 import time
 from datetime import datetime, timedelta
+from urllib.parse import unquote
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
+import orjson
 
 # --- 基础配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,6 +32,33 @@ UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 API_KEY = "your_secret_api_key"  # 简单的认证密钥
 CLEANUP_INTERVAL_MINUTES = 1 # 清理任务运行频率（分钟）
 FILE_MAX_AGE_MINUTES = 10 # 文件最大保留时间（分钟）
+PRESIGNED_URL_EXPIRE_SECONDS = 300 # 预签名上传地址的有效期（秒）
+# 预签名地址的签名密钥：每次启动时随机生成，不使用（可能是公开默认值的）API_KEY
+_PRESIGN_SECRET = secrets.token_bytes(32)
+BASE64_DECODE_CHUNK_SIZE = 64 * 1024 # base64 分块解码时每块的字符数（必须是 4 的倍数）
+_BASE64_WHITESPACE = b" \t\r\n" # base64 文本中允许出现并需忽略的空白字符
+_DATA_URI_HEADER_LIMIT = 1024 # data URI 头部（逗号之前）的最大长度
+# 允许沿用的原始扩展名：只含字母和数字，保证生成的文件名可以原样放进 URL 路径
+_SAFE_EXTENSION_RE = re.compile(r'\.[A-Za-z0-9]{1,16}')
+# 服务器签发的文件名：uuid4 加上安全的扩展名。预签名上传只接受这种文件名，杜绝路径穿越
+_ISSUED_FILENAME_RE = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}' + _SAFE_EXTENSION_RE.pattern
+)
+# 常见 MIME 类型对应的扩展名，命中时无需再查询 mimetypes 数据库
+_MIME_EXT = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "application/pdf": ".pdf",
+}
+
+# --- 响应类 ---
+class ORJSONResponse(JSONResponse):
+    """使用 orjson 序列化的 JSON 响应（FastAPI 自带的 ORJSONResponse 已弃用）。"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
 # --- 清理函数 ---
 def cleanup_old_files():
@@ -34,17 +70,16 @@ def cleanup_old_files():
     
     deleted_count = 0
     try:
-        for filename in os.listdir(UPLOAD_DIR):
-            file_path = os.path.join(UPLOAD_DIR, filename)
-            if os.path.isfile(file_path):
+        # scandir 的 DirEntry 会缓存类型信息，每个文件只需一次 stat
+        with os.scandir(UPLOAD_DIR) as entries:
+            for entry in entries:
                 try:
-                    file_mtime = os.path.getmtime(file_path)
-                    if file_mtime < cutoff:
-                        os.remove(file_path)
-                        logger.info(f"已删除过期文件: {filename}")
+                    if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        logger.info(f"已删除过期文件: {entry.name}")
                         deleted_count += 1
                 except OSError as e:
-                    logger.error(f"删除文件 '{file_path}' 时出错: {e}")
+                    logger.error(f"删除文件 '{entry.path}' 时出错: {e}")
     except Exception as e:
         logger.error(f"清理旧文件时发生未知错误: {e}", exc_info=True)
 
@@ -54,19 +89,24 @@ def cleanup_old_files():
         logger.info("清理任务完成，没有找到需要删除的文件。")
 
 
-# --- FastAPI 生命周期事件 ---
-scheduler = BackgroundScheduler(timezone="UTC")
+async def cleanup_loop():
+    """后台任务：按固定间隔运行清理函数，文件系统操作放到工作线程中执行。"""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL_MINUTES * 60)
+        await asyncio.to_thread(cleanup_old_files)
 
+
+# --- FastAPI 生命周期事件 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在服务器启动时启动后台任务，在关闭时停止。"""
-    # 启动调度器并添加任务
-    scheduler.add_job(cleanup_old_files, 'interval', minutes=CLEANUP_INTERVAL_MINUTES)
-    scheduler.start()
+    cleanup_task = asyncio.create_task(cleanup_loop())
     logger.info(f"后台文件清理任务已启动，每 {CLEANUP_INTERVAL_MINUTES} 分钟运行一次。")
     yield
-    # 关闭调度器
-    scheduler.shutdown()
+    cleanup_task.cancel()
+    # 等待任务真正结束，避免关闭时出现 "Task was destroyed but it is pending" 警告
+    with contextlib.suppress(asyncio.CancelledError):
+        await cleanup_task
     logger.info("后台文件清理任务已停止。")
 
 
@@ -86,54 +126,288 @@ class UploadRequest(BaseModel):
     file_data: str # 接收完整的 base64 data URI
     api_key: str | None = None
 
-# --- API 端点 ---
-@app.post("/upload")
-async def upload_file(request: UploadRequest, http_request: Request):
+class PresignRequest(BaseModel):
+    file_name: str
+    content_type: str | None = None
+    size: int | None = None
+    api_key: str | None = None
+
+# --- 上传辅助函数 ---
+def _check_api_key(api_key: str | None):
+    """简单的 API Key 认证。"""
+    if API_KEY and api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="无效的 API Key")
+
+def _new_upload_path(file_name: str, mime_type: str | None) -> tuple[str, str]:
+    """生成唯一文件名以避免冲突，返回 (unique_filename, file_path)。"""
+    file_extension = os.path.splitext(file_name)[1]
+    if not _SAFE_EXTENSION_RE.fullmatch(file_extension):
+        # 没有扩展名或含有 "?"、"#" 等特殊字符时，尝试从 mime 类型来猜测扩展名，常见类型直接查表
+        file_extension = (mime_type and (_MIME_EXT.get(mime_type) or mimetypes.guess_extension(mime_type))) or '.bin'
+        if not _SAFE_EXTENSION_RE.fullmatch(file_extension):
+            # 本地 mime.types 中可能登记了不安全的扩展名
+            file_extension = '.bin'
+
+    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    return unique_filename, os.path.join(UPLOAD_DIR, unique_filename)
+
+def _upload_success(original_name: str, unique_filename: str) -> ORJSONResponse:
+    logger.info(f"文件 '{original_name}' 已成功保存为 '{unique_filename}'。")
+    return ORJSONResponse(
+        status_code=200,
+        content={"success": True, "filename": unique_filename}
+    )
+
+async def _save_multipart_upload(http_request: Request) -> ORJSONResponse:
+    """处理 multipart/form-data 上传，文件内容以流的方式直接复制到磁盘。"""
+    form = await http_request.form()
+    _check_api_key(form.get("api_key") or None)
+
+    upload = form.get("file")
+    if upload is None or isinstance(upload, str):
+        raise HTTPException(status_code=400, detail="缺少 'file' 字段")
+
+    file_name = form.get("file_name") or upload.filename or ""
+    unique_filename, file_path = _new_upload_path(file_name, upload.content_type)
+
+    # 复制可能较大的临时文件属于阻塞 I/O，放到工作线程中执行
+    await asyncio.to_thread(_copy_to_file, upload.file, file_path)
+    await upload.close()
+
+    return _upload_success(file_name, unique_filename)
+
+def _copy_to_file(source, file_path: str):
+    """将已打开的文件对象按块复制到 file_path。"""
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(source, f, length=64 * 1024)
+
+def _decode_base64_chunk(pending: bytes, chunk: bytes) -> tuple[bytes, bytes]:
     """
-    接收 base64 编码的文件并保存，返回可访问的 URL。
+    增量解码一块 base64 数据，返回 (decoded, pending)。
+    空白字符会被忽略；凑不满 4 个字符的尾部留在 pending 中与下一块拼接。
     """
-    # 简单的 API Key 认证
-    if API_KEY and request.api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="无效的 API Key")
+    data = pending + chunk.translate(None, _BASE64_WHITESPACE)
+    cut = len(data) - len(data) % 4
+    return base64.b64decode(data[:cut]), data[cut:]
+
+def _remove_partial_file(file_path: str):
+    """解码失败或上传中断时删除已写入一部分的文件。"""
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+def _save_data_uri_upload(request: UploadRequest) -> ORJSONResponse:
+    """处理旧版 JSON + base64 data URI 上传。"""
+    _check_api_key(request.api_key)
 
+    # 1. 解析 base64 data URI
+    comma = request.file_data.index(',')
+    header = request.file_data[:comma]
+
+    # 2. 生成唯一文件名以避免冲突
+    mime_type = header.split(';')[0].split(':')[1]
+    unique_filename, file_path = _new_upload_path(request.file_name, mime_type)
+
+    # 3. 按块解码 base64 数据并写入文件，不在内存中生成完整的解码结果
+    encoded_data = request.file_data
+    pending = b""
     try:
-        # 1. 解析 base64 data URI
-        header, encoded_data = request.file_data.split(',', 1)
-        
-        # 2. 解码 base64 数据
-        file_data = base64.b64decode(encoded_data)
-        
-        # 3. 生成唯一文件名以避免冲突
-        file_extension = os.path.splitext(request.file_name)[1]
-        if not file_extension:
-            # 尝试从 header 中获取 mime 类型来猜测扩展名
-            import mimetypes
-            mime_type = header.split(';')[0].split(':')[1]
-            guessed_extension = mimetypes.guess_extension(mime_type)
-            file_extension = guessed_extension if guessed_extension else '.bin'
-
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-        # 4. 保存文件
         with open(file_path, "wb") as f:
-            f.write(file_data)
-        
-        # 5. 返回成功信息和唯一文件名
-        logger.info(f"文件 '{request.file_name}' 已成功保存为 '{unique_filename}'。")
-        
-        return JSONResponse(
-            status_code=200,
-            content={"success": True, "filename": unique_filename}
-        )
+            for start in range(comma + 1, len(encoded_data), BASE64_DECODE_CHUNK_SIZE):
+                chunk = encoded_data[start:start + BASE64_DECODE_CHUNK_SIZE].encode("ascii")
+                decoded, pending = _decode_base64_chunk(pending, chunk)
+                f.write(decoded)
+            if pending:
+                f.write(base64.b64decode(pending))
+    except ValueError:
+        _remove_partial_file(file_path)
+        raise
+
+    # 4. 返回成功信息和唯一文件名
+    return _upload_success(request.file_name, unique_filename)
+
+async def _save_base64_body_upload(http_request: Request) -> ORJSONResponse:
+    """
+    处理 application/base64 上传：请求体直接是 base64 文本（或完整的 data URI），
+    元数据放在请求头中，避免在 JSON 中编码/解析整个 base64 字符串。
+    """
+    _check_api_key(http_request.headers.get("x-api-key") or None)
+    file_name = unquote(http_request.headers.get("x-file-name", ""))
+
+    # 先读取足够判断是否为 data URI 的开头部分；若是，读到逗号为止以取得媒体类型
+    chunks = http_request.stream()
+    head = b""
+    async for chunk in chunks:
+        head += chunk
+        if len(head) < 5:
+            continue
+        if not head.startswith(b"data:") or b"," in head:
+            break
+        if len(head) > _DATA_URI_HEADER_LIMIT:
+            raise ValueError("data URI 头部过长")
+
+    mime_type = None
+    if head.startswith(b"data:"):
+        header, head = head.split(b",", 1)
+        mime_type = header[5:].split(b";", 1)[0].decode("ascii")
 
+    # 其余请求体按块边接收边解码写入磁盘
+    unique_filename, file_path = _new_upload_path(file_name, mime_type)
+    f = await asyncio.to_thread(open, file_path, "wb")
+    try:
+        with f:
+            decoded, pending = _decode_base64_chunk(b"", head)
+            await asyncio.to_thread(f.write, decoded)
+            async for chunk in chunks:
+                decoded, pending = _decode_base64_chunk(pending, chunk)
+                await asyncio.to_thread(f.write, decoded)
+            if pending:
+                await asyncio.to_thread(f.write, base64.b64decode(pending))
+    except BaseException:
+        # 包括解码失败和客户端中途断开（例如客户端取消了上传）
+        _remove_partial_file(file_path)
+        raise
+
+    return _upload_success(file_name, unique_filename)
+
+async def _save_raw_body_upload(http_request: Request, content_type: str) -> ORJSONResponse:
+    """
+    处理原始字节上传：请求体即文件内容，Content-Type 为文件的媒体类型，
+    文件名与 API Key 通过 X-File-Name (URL 编码) 和 X-API-Key 请求头传递。
+    请求体按块直接写入磁盘，无需 base64 解码。
+    """
+    _check_api_key(http_request.headers.get("x-api-key") or None)
+    file_name = unquote(http_request.headers.get("x-file-name", ""))
+    mime_type = content_type.split(";", 1)[0].strip() or None
+
+    unique_filename, file_path = _new_upload_path(file_name, mime_type)
+    await _write_request_body(http_request, file_path)
+
+    return _upload_success(file_name, unique_filename)
+
+async def _write_request_body(http_request: Request, file_path: str, expected_size: int | None = None):
+    """
+    将请求体按块直接写入磁盘，阻塞的文件操作放到工作线程中执行。
+    给出 expected_size 时，请求体必须恰好是这么多字节，超出时立即中止。
+    """
+    written = 0
+    f = await asyncio.to_thread(open, file_path, "wb")
+    try:
+        with f:
+            async for chunk in http_request.stream():
+                written += len(chunk)
+                if expected_size is not None and written > expected_size:
+                    raise HTTPException(status_code=413, detail="上传内容超过了预签名时声明的大小")
+                await asyncio.to_thread(f.write, chunk)
+        if expected_size is not None and written != expected_size:
+            raise HTTPException(status_code=400, detail="上传内容与预签名时声明的大小不一致")
+    except BaseException:
+        # 客户端中途断开或大小不符时不留下不完整的文件
+        _remove_partial_file(file_path)
+        raise
+
+def _presign_signature(filename: str, expires: int, size: int | None) -> str:
+    """签名覆盖文件名、有效期和声明的大小（未声明时为空），任何一项被篡改都会校验失败。"""
+    message = f"{filename}:{expires}:{'' if size is None else size}"
+    return hmac.new(_PRESIGN_SECRET, message.encode(), hashlib.sha256).hexdigest()
+
+# --- API 端点 ---
+@app.post("/upload")
+async def upload_file(http_request: Request):
+    """
+    接收文件并保存，返回可访问的 URL。
+    - multipart/form-data: 字段 file (文件)、file_name、api_key。
+    - application/base64: 请求体为 base64 文本或 data URI，文件名与 API Key 通过
+      X-File-Name (URL 编码) 和 X-API-Key 请求头传递。
+    - application/json (旧版): {"file_name", "file_data" (base64 data URI), "api_key"}。
+    - 其他 Content-Type: 请求体即原始文件字节，Content-Type 为文件的媒体类型，
+      文件名与 API Key 通过 X-File-Name (URL 编码) 和 X-API-Key 请求头传递。
+    - 带有 X-Upload-Format: raw 请求头时一律按原始文件字节处理，不再根据 Content-Type 判断，
+      避免媒体类型恰好是 application/json 等的文件被误判为其他上传格式。
+    """
+    content_type = http_request.headers.get("content-type", "")
+    try:
+        if http_request.headers.get("x-upload-format") == "raw":
+            return await _save_raw_body_upload(http_request, content_type)
+        if content_type.startswith("multipart/form-data"):
+            return await _save_multipart_upload(http_request)
+        if content_type.startswith("application/base64"):
+            return await _save_base64_body_upload(http_request)
+        if content_type.startswith("application/json"):
+            return await asyncio.to_thread(_save_data_uri_upload, UploadRequest(**await http_request.json()))
+        return await _save_raw_body_upload(http_request, content_type)
+
+    except HTTPException:
+        raise
     except (ValueError, IndexError) as e:
-        logger.error(f"解析 base64 数据时出错: {e}")
-        raise HTTPException(status_code=400, detail=f"无效的 base64 data URI 格式: {e}")
+        logger.error(f"解析上传数据时出错: {e}")
+        raise HTTPException(status_code=400, detail=f"无效的上传数据格式: {e}")
     except Exception as e:
         logger.error(f"处理文件上传时发生未知错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"内部服务器错误: {e}")
 
+@app.post("/upload_raw")
+async def upload_raw(http_request: Request):
+    """
+    原始字节上传：无论 Content-Type 是什么，请求体都按文件内容原样写入磁盘。
+    文件名与 API Key 通过 X-File-Name (URL 编码) 和 X-API-Key 请求头传递。
+    适用于文件本身的媒体类型恰好是 application/json 或 multipart/* 等、
+    会被 /upload 误判为其他上传格式的情况。
+    """
+    content_type = http_request.headers.get("content-type", "")
+    try:
+        return await _save_raw_body_upload(http_request, content_type)
+    except HTTPException:
+        raise
+    except OSError as e:
+        logger.error(f"保存上传文件时出错: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"内部服务器错误: {e}")
+
+@app.post("/presign")
+async def presign_upload(request: PresignRequest):
+    """
+    签发一个预签名上传地址。客户端随后将文件内容直接 PUT 到返回的 url，
+    无需再携带 API Key。返回的 url 是相对于文件床根路径的地址。
+    """
+    _check_api_key(request.api_key)
+
+    if request.size is not None and request.size < 0:
+        raise HTTPException(status_code=400, detail="无效的文件大小")
+
+    unique_filename, _ = _new_upload_path(request.file_name, request.content_type)
+    expires = int(time.time()) + PRESIGNED_URL_EXPIRE_SECONDS
+    signature = _presign_signature(unique_filename, expires, request.size)
+    # 声明了大小时一并写入地址，PUT 的请求体必须与之相符
+    size_query = "" if request.size is None else f"&size={request.size}"
+    logger.info(f"已为文件 '{request.file_name}' 签发预签名上传地址: '{unique_filename}'。")
+
+    return ORJSONResponse(
+        status_code=200,
+        content={
+            "success": True,
+            "filename": unique_filename,
+            "method": "PUT",
+            "url": f"/direct/{unique_filename}?expires={expires}{size_query}&signature={signature}",
+            "headers": {"Content-Type": request.content_type or "application/octet-stream"},
+            "expires": expires,
+        }
+    )
+
+@app.put("/direct/{filename}")
+async def direct_upload(filename: str, expires: int, signature: str, http_request: Request, size: int | None = None):
+    """接收预签名地址上的 PUT 上传，校验文件名、签名与有效期后将请求体直接写入磁盘。"""
+    # 只接受 /presign 签发的文件名，即使签名被伪造也无法写到上传目录之外
+    if not _ISSUED_FILENAME_RE.fullmatch(filename):
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    if expires < time.time():
+        raise HTTPException(status_code=403, detail="预签名地址已过期")
+    if not hmac.compare_digest(signature, _presign_signature(filename, expires, size)):
+        raise HTTPException(status_code=403, detail="无效的签名")
+
+    await _write_request_body(http_request, os.path.join(UPLOAD_DIR, filename), expected_size=size)
+    return _upload_success(filename, filename)
+
 @app.get("/")
 def read_root():
     return {"message": "LMArena Bridge 文件床服务器正在运行。"}
@@ -1,54 +1,478 @@
 # modules/file_uploader.py
+import asyncio
+import os
+import random
+import re
+import time
+import warnings
 import httpx
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
-from typing import Tuple
+# 可选依赖：pybase64 使用 SIMD (AVX2/SSSE3/NEON) 加速 base64 编解码，未安装时回退到标准库。
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
-from typing import Tuple
+from dataclasses import dataclass
+from enum import Enum
+from typing import AsyncIterator, BinaryIO, Callable, Tuple
+from urllib.parse import quote
 
-async def upload_to_file_bed(file_name: str, file_data: str, upload_url: str, api_key: str | None = None) -> Tuple[str | None, str | None]:
+class UploadError(Enum):
+    """上传失败的类型，调用方可据此决定是否重试，而无需解析错误字符串。"""
+    CONNECT = "connect"                 # 连接失败等网络错误
+    TIMEOUT = "timeout"                 # 连接/读/写/连接池超时
+    HTTP_4XX = "http_4xx"               # 文件床返回 4xx（如 API Key 错误），重试无意义
+    HTTP_5XX = "http_5xx"               # 文件床返回 5xx
+    SERVER_REPORTED = "server_reported" # 文件床返回 200，但报告上传失败
+    CIRCUIT_OPEN = "circuit_open"       # 熔断器打开，请求未发出
+    INVALID_DATA = "invalid_data"       # 本地数据无效（如 base64 格式错误）
+    UNKNOWN = "unknown"
+
+class _PresignError(Exception):
+    """文件床返回了 200，但预签名响应中缺少可用的上传地址。"""
+
+# 上传结果：(filename, error, error_message)。成功时 error 为 None 且 error_message 为空字符串。
+UploadResult = Tuple[str | None, UploadError | None, str]
+
+# 模块级共享的 AsyncClient，所有上传复用同一个连接池（keep-alive），
+# 避免每次上传都重新进行 DNS 解析、TCP 与 TLS 握手。
+_client: httpx.AsyncClient | None = None
+
+# 分阶段超时：握手/DNS 故障 5 秒内失败，连接池排队 2 秒内失败，读写保留 60 秒给大文件。
+UPLOAD_TIMEOUT = httpx.Timeout(connect=5.0, read=60.0, write=60.0, pool=2.0)
+
+# 连接池上限。上传密集的场景下 httpx 的默认值 (100, 20) 容易在突发上传时排队，
+# 可按需调整此值（例如并发附件更多时调大 max_connections）。
+UPLOAD_CONNECTION_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30.0)
+
+# 不同超时类型使用不同的错误描述，便于区分是文件床后端问题还是本地连接池饱和。
+_TIMEOUT_ERROR_LABELS = {
+    httpx.ConnectTimeout: "连接超时 (ConnectTimeout)",
+    httpx.ReadTimeout: "读取超时 (ReadTimeout)",
+    httpx.WriteTimeout: "写入超时 (WriteTimeout)",
+    httpx.PoolTimeout: "本地连接池等待超时 (PoolTimeout)",
+}
+
+async def _get_client() -> httpx.AsyncClient:
+    """惰性创建并返回共享的 AsyncClient。"""
+    global _client
+    if _client is None or _client.is_closed:
+        # 使用专用 transport：http2/limits 必须设置在 transport 上（传入 transport 时 AsyncClient 的同名参数不生效）。
+        # retries=0：重试由 _send_with_retry 统一负责，避免与底层连接重试叠加。
+        transport = httpx.AsyncHTTPTransport(
+            http2=True, # 多个并发上传复用同一条 HTTP/2 连接；服务端不支持时自动回退到 HTTP/1.1
+            limits=UPLOAD_CONNECTION_LIMITS,
+            retries=0,
+        )
+        _client = httpx.AsyncClient(timeout=UPLOAD_TIMEOUT, transport=transport)
+    return _client
+
+# 预热任务的引用，防止 fire-and-forget 的任务在完成前被垃圾回收
+_warmup_tasks: set[asyncio.Task] = set()
+
+async def _warm_connection(upload_url: str):
+    try:
+        client = await _get_client()
+        await client.head(upload_url)
+        logger.info("已预热到文件床 '%s' 的连接。", upload_url)
+    except httpx.HTTPError as e:
+        logger.warning("预热文件床连接失败: %s", e)
+
+def warm_up(upload_url: str):
+    """
+    在后台向文件床发送一次 HEAD 请求，提前完成 DNS 解析与 TCP/TLS 握手，
+    使连接池中留有可复用的连接，首次上传无需再承担握手开销。结果被忽略。
+    必须在运行中的事件循环内调用（例如应用启动时）。
+    """
+    task = asyncio.create_task(_warm_connection(upload_url))
+    _warmup_tasks.add(task)
+    task.add_done_callback(_warmup_tasks.discard)
+
+async def aclose() -> None:
+    """关闭共享的 AsyncClient。应在应用关闭时调用。"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+_READ_CHUNK_SIZE = 64 * 1024
+_ERROR_BODY_LIMIT = 2048
+
+# 同时进行的上传请求上限（舱壁隔离），避免单个请求中的大量附件占满连接池。
+MAX_CONCURRENT_UPLOADS = 8
+_upload_sem = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+# --- 重试配置 ---
+# 仅对可安全重试的瞬时故障（连接失败、读超时、502/503/504）进行有限次数的指数退避重试。
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5 # 秒
+RETRY_MAX_DELAY = 4.0 # 秒
+_RETRY_STATUS_CODES = frozenset({502, 503, 504})
+
+# --- 熔断器配置 ---
+# 连续失败达到阈值后熔断器打开，在冷却期内直接快速失败，冷却结束后放行一个探测请求（半开）。
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+
+@dataclass
+class _BreakerState:
+    failures: int = 0
+    opened_at: float | None = None
+    probing: bool = False
+
+# 以 upload_url 为键的熔断器状态
+_breakers: dict[str, _BreakerState] = {}
+
+# 没有 /upload_raw 端点的旧版文件床（以 upload_url 为键），之后改用旧版 JSON 格式向 upload_url 上传
+_raw_endpoint_missing: set[str] = set()
+
+def _breaker_allow(state: _BreakerState) -> bool:
+    """判断熔断器是否允许发出请求；冷却期结束后只放行一个半开探测请求。"""
+    if state.opened_at is None:
+        return True
+    if state.probing or time.monotonic() - state.opened_at < CIRCUIT_COOLDOWN_SECONDS:
+        return False
+    state.probing = True
+    return True
+
+def _breaker_record(state: _BreakerState, upload_url: str, ok: bool):
+    """记录一次请求结果：成功则重置，失败则累加并在达到阈值（或半开探测失败）时打开熔断器。"""
+    state.probing = False
+    if ok:
+        if state.opened_at is not None:
+            logger.info("文件床 '%s' 已恢复，熔断器关闭。", upload_url)
+        state.failures = 0
+        state.opened_at = None
+        return
+    state.failures += 1
+    if state.opened_at is not None or state.failures >= CIRCUIT_FAILURE_THRESHOLD:
+        state.opened_at = time.monotonic()
+        logger.warning("文件床 '%s' 连续失败 %d 次，熔断器打开 %.0f 秒。", upload_url, state.failures, CIRCUIT_COOLDOWN_SECONDS)
+
+async def _aiter_stream(stream: BinaryIO, start: int | None = None) -> AsyncIterator[bytes]:
+    """
+    按块读取二进制流，作为 httpx 的请求体惰性发送。
+    阻塞的 seek/read 放到工作线程中执行，不占用事件循环。start 不为 None 时先定位到该偏移。
+    """
+    if start is not None:
+        await asyncio.to_thread(stream.seek, start)
+    while chunk := await asyncio.to_thread(stream.read, _READ_CHUNK_SIZE):
+        yield chunk
+
+async def _aiter_file(path: str | os.PathLike) -> AsyncIterator[bytes]:
+    """按块读取本地文件，文件在请求体发送完毕后关闭。"""
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        async for chunk in _aiter_stream(f):
+            yield chunk
+    finally:
+        f.close()
+
+# data URI 头部 ("data:image/png;base64,") 的最大长度，查找逗号时只扫描这一段，不会扫描整个载荷。
+_DATA_URI_HEADER_LIMIT = 256
+
+def split_data_uri(data_uri: str) -> Tuple[str, int]:
+    """
+    解析 data URI 的头部，返回 (media_type, 载荷起始下标)。
+    只在前 _DATA_URI_HEADER_LIMIT 个字符内查找逗号，开销与载荷大小无关。
+    """
+    comma = data_uri.find(",", 0, _DATA_URI_HEADER_LIMIT)
+    if not data_uri.startswith("data:") or comma == -1:
+        raise ValueError(f"无效的 data URI: {data_uri[:50]}...")
+    media_type = data_uri[5:comma].split(";", 1)[0] or "application/octet-stream"
+    return media_type, comma + 1
+
+# 流式解码时每块 base64 字符数（每块解码后约 64KB）。
+_B64_STREAM_CHUNK = (_READ_CHUNK_SIZE // 3) * 4
+# 小于此大小（解码后约 32KB）的 base64 载荷不走流式解码
+_SMALL_UPLOAD_B64_LIMIT = (32 * 1024 // 3) * 4
+# base64 文本中允许出现并需忽略的空白字符（如 base64.encodebytes 的换行）
+_B64_WHITESPACE = b" \t\r\n\v\f"
+# 不含空白、只在末尾带填充的规范 base64 文本，只有这种文本才能由字符数精确算出解码后的长度
+_B64_CANONICAL_RE = re.compile(rb'[A-Za-z0-9+/]*={0,2}')
+
+def _b64decode_strict(data: bytes | memoryview) -> bytes:
+    """忽略空白字符后严格解码；含有非法字符或填充错误时抛出 ValueError (binascii.Error)。"""
+    return base64.b64decode(bytes(data).translate(None, _B64_WHITESPACE), validate=True)
+
+async def _aiter_b64_decoded(payload_b64: memoryview) -> AsyncIterator[bytes]:
+    """
+    按块解码 base64 载荷并逐块产出，避免一次性生成完整的解码结果。
+    空白字符会被忽略；凑不满 4 个字符的尾部留到下一块拼接。非法数据抛出 ValueError。
+    """
+    pending = b""
+    for i in range(0, len(payload_b64), _B64_STREAM_CHUNK):
+        data = pending + bytes(payload_b64[i:i + _B64_STREAM_CHUNK]).translate(None, _B64_WHITESPACE)
+        cut = len(data) - len(data) % 4
+        pending = data[cut:]
+        if cut:
+            yield base64.b64decode(data[:cut], validate=True)
+    if pending:
+        yield base64.b64decode(pending, validate=True)
+
+def _normalize_b64(payload_b64: memoryview) -> memoryview:
+    """
+    返回规范化（去除空白）后的 base64 载荷；已是规范形式时不做拷贝。
+    含有非法字符或长度不是 4 的倍数时抛出 ValueError。
+    """
+    if not _B64_CANONICAL_RE.fullmatch(payload_b64):
+        payload_b64 = memoryview(bytes(payload_b64).translate(None, _B64_WHITESPACE))
+        if not _B64_CANONICAL_RE.fullmatch(payload_b64):
+            raise ValueError("包含非 base64 字符或位置错误的填充")
+    if len(payload_b64) % 4:
+        raise ValueError("Incorrect padding")
+    return payload_b64
+
+def _b64_decoded_length(payload_b64: memoryview) -> int:
+    """根据 base64 载荷长度与末尾填充计算解码后的字节数；载荷必须先经过 _normalize_b64。"""
+    padding = bytes(payload_b64[-2:]).count(b"=")
+    return len(payload_b64) // 4 * 3 - padding
+
+def _read_upload_source(data: bytes | bytearray | memoryview | str | os.PathLike | BinaryIO) -> Tuple[Callable[[], bytes | AsyncIterator[bytes]], bool]:
     """
-    将 base64 编码的文件上传到文件床服务器。
+    将上传来源统一转换为 (请求体工厂, 是否可重放)。
+    每次调用请求体工厂都会得到一份从头开始的请求体，以便重试时重新发送。
+    - bytes / bytearray / memoryview: 直接作为请求体（后两者先转换为 bytes）。
+    - 文件路径 (str 或 os.PathLike) / 已打开的二进制流: 按块惰性读取；不可 seek 的流无法重放。
+    """
+    if isinstance(data, (bytearray, memoryview)):
+        # httpx 只把 bytes 当作一次性请求体，bytearray / memoryview 会被当成同步迭代器，
+        # 在 AsyncClient 上发送时报错
+        data = bytes(data)
+    if isinstance(data, bytes):
+        return (lambda: data), True
+    if isinstance(data, (str, os.PathLike)):
+        return (lambda: _aiter_file(data)), True
+    if not hasattr(data, "read"):
+        raise TypeError(f"不支持的上传数据类型: {type(data).__name__}（应为 bytes、文件路径或二进制流）")
+    if data.seekable():
+        start = data.tell()
+        return (lambda: _aiter_stream(data, start)), True
+    return (lambda: _aiter_stream(data)), False
+
+async def _send_with_retry(client: httpx.AsyncClient, method: str, url: str | httpx.URL, make_content: Callable[[], bytes | AsyncIterator[bytes]], headers: dict, max_attempts: int) -> httpx.Response:
+    """
+    发送请求，对瞬时故障进行带抖动的指数退避重试。
+    4xx 等其他响应直接返回，由调用方处理。
+    """
+    for attempt in range(max_attempts):
+        try:
+            async with _upload_sem:
+                response = await client.request(method, url, content=make_content(), headers=headers)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout) as e:
+            if attempt + 1 >= max_attempts:
+                raise
+            reason = f"{type(e).__name__}: {e}"
+        else:
+            if response.status_code not in _RETRY_STATUS_CODES or attempt + 1 >= max_attempts:
+                return response
+            reason = f"HTTP {response.status_code}"
+
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * (0.5 + random.random())
+        logger.warning("上传到文件床失败 (%s)，%.2f 秒后进行第 %d/%d 次尝试...", reason, delay, attempt + 2, max_attempts)
+        await asyncio.sleep(delay)
+
+async def upload_to_file_bed(file_name: str, media_type: str, data: bytes | bytearray | memoryview | str | os.PathLike | BinaryIO, upload_url: str, api_key: str | None = None, presigned: bool = False) -> UploadResult:
+    """
+    将文件以原始字节的形式上传到文件床服务器（请求体即文件内容，不再经过 base64）。
 
     :param file_name: 原始文件名。
-    :param file_data: Base64 data URI (例如, "data:image/png;base64,...").
-    :param upload_url: 文件床的 /upload 端点 URL。
+    :param media_type: 文件的媒体类型 (例如, "image/png")，作为请求的 Content-Type。
+    :param data: 文件内容，可以是 bytes / bytearray / memoryview、本地文件路径 (str 或 os.PathLike)，或已打开的二进制流。
+    :param upload_url: 文件床的 /upload 端点 URL。原始字节实际发送到同目录的 /upload_raw（旧版文件床回退到该地址）。
     :param api_key: (可选) 用于认证的 API Key。
-    :return: 一个元组 (filename, error_message)。成功时 filename 是字符串，error_message 是 None；
-             失败时 filename 是 None，error_message 是包含错误信息的字符串。
-    """
-    payload = {
-        "file_name": file_name,
-        "file_data": file_data,
-        "api_key": api_key
-    }
-    
+    :param presigned: (可选) 为 True 时先向文件床的 /presign 申请预签名地址，再将文件 PUT 到该地址。
+    :return: 一个元组 (filename, error, error_message)。成功时 filename 是字符串，error 是 None，
+             error_message 是空字符串；失败时 filename 是 None，error 是 UploadError，
+             error_message 是包含错误信息的字符串。
+    """
+    make_content, replayable = _read_upload_source(data)
+    return await _upload(file_name, media_type, make_content, replayable, upload_url, api_key, presigned=presigned)
+
+async def upload_base64_to_file_bed(file_name: str, media_type: str, payload_b64: str | bytes | memoryview, upload_url: str, api_key: str | None = None, presigned: bool = False) -> UploadResult:
+    """
+    上传 base64 编码的文件内容（不含 "data:...;base64," 头部）。
+    载荷在发送时按约 64KB 的块边解码边写入请求体，不会在内存中生成完整的解码结果。
+
+    参数与返回值同 upload_to_file_bed，其中 payload_b64 为 base64 文本。
+    """
+    if isinstance(payload_b64, str):
+        payload_b64 = payload_b64.encode("ascii")
+    payload_b64 = memoryview(payload_b64)
+    # 小文件（解码后 < 32KB）直接一次性解码后发送，省去生成器与流式发送的开销
+    if len(payload_b64) < _SMALL_UPLOAD_B64_LIMIT:
+        try:
+            data = _b64decode_strict(payload_b64)
+        except ValueError as e:
+            logger.error("解码 base64 数据时出错: %s", e)
+            return None, UploadError.INVALID_DATA, f"无效的 base64 数据: {e}"
+        return await upload_to_file_bed(file_name, media_type, data, upload_url, api_key, presigned=presigned)
+    # 流式上传需要预先声明 Content-Length：先规范化载荷，保证算出的长度与实际发送的字节数一致
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(upload_url, json=payload)
-            
-            response.raise_for_status()  # 如果状态码是 4xx 或 5xx，则引发异常
-            
-            result = response.json()
-            if result.get("success") and result.get("filename"):
-                logger.info(f"文件 '{file_name}' 成功上传到文件床，文件名为: {result['filename']}")
-                return result["filename"], None
+        payload_b64 = _normalize_b64(payload_b64)
+    except ValueError as e:
+        logger.error("解码 base64 数据时出错: %s", e)
+        return None, UploadError.INVALID_DATA, f"无效的 base64 数据: {e}"
+    return await _upload(
+        file_name, media_type, lambda: _aiter_b64_decoded(payload_b64), True, upload_url, api_key,
+        content_length=_b64_decoded_length(payload_b64), presigned=presigned,
+    )
+
+async def request_presigned(client: httpx.AsyncClient, upload_url: str, file_name: str, media_type: str, size: int | None, api_key: str | None) -> httpx.Response:
+    """
+    向文件床的 /presign 端点申请预签名上传地址（与 upload_url 位于同一目录）。
+    成功时响应体为 {"success", "filename", "method", "url", "headers", "expires"}。
+    """
+    body = orjson.dumps({"file_name": file_name, "content_type": media_type, "size": size, "api_key": api_key})
+    return await _send_with_retry(
+        client, "POST", httpx.URL(upload_url).join("presign"), lambda: body,
+        {"Content-Type": "application/json"}, RETRY_MAX_ATTEMPTS,
+    )
+
+async def _upload_presigned(client: httpx.AsyncClient, upload_url: str, file_name: str, media_type: str, make_content: Callable[[], bytes | AsyncIterator[bytes]], max_attempts: int, api_key: str | None, content_length: int | None) -> httpx.Response:
+    """两步上传：先申请预签名地址，再将文件内容直接 PUT 到该地址（无需再携带 API Key）。"""
+    presign_response = await request_presigned(client, upload_url, file_name, media_type, content_length, api_key)
+    if presign_response.status_code != 200:
+        return presign_response
+    ticket = orjson.loads(presign_response.content)
+    target_url = ticket.get("url") if isinstance(ticket, dict) else None
+    if not target_url:
+        error_msg = ticket.get("error") if isinstance(ticket, dict) else None
+        raise _PresignError(error_msg or "文件床的预签名响应中缺少上传地址 (url)。")
+    headers = dict(ticket.get("headers") or {})
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+    return await _send_with_retry(
+        client, ticket.get("method", "PUT"), httpx.URL(upload_url).join(target_url),
+        make_content, headers, max_attempts,
+    )
+
+async def _post_legacy_json(client: httpx.AsyncClient, upload_url: str, file_name: str, media_type: str, make_content: Callable[[], bytes | AsyncIterator[bytes]], api_key: str | None, max_attempts: int) -> httpx.Response:
+    """
+    按旧版文件床唯一支持的格式上传：JSON 请求体 {"file_name", "file_data" (base64 data URI), "api_key"}。
+    需要先读出完整内容再编码，只作为兼容旧版文件床的回退路径使用。
+    """
+    content = make_content()
+    if not isinstance(content, bytes):
+        content = b"".join([chunk async for chunk in content])
+    data_uri = f"data:{media_type or 'application/octet-stream'};base64,{base64.b64encode(content).decode('ascii')}"
+    body = orjson.dumps({"file_name": file_name, "file_data": data_uri, "api_key": api_key})
+    return await _send_with_retry(
+        client, "POST", upload_url, lambda: body, {"Content-Type": "application/json"}, max_attempts,
+    )
+
+async def _post_raw(client: httpx.AsyncClient, upload_url: str, file_name: str, media_type: str, make_content: Callable[[], bytes | AsyncIterator[bytes]], headers: dict, api_key: str | None, max_attempts: int, replayable: bool) -> httpx.Response:
+    """
+    将原始字节 POST 到与 upload_url 同目录的 /upload_raw 端点。
+    旧版文件床没有该端点 (404) 时记住这一点，并改用旧版 JSON + data URI 格式上传到 upload_url。
+    """
+    if upload_url not in _raw_endpoint_missing:
+        response = await _send_with_retry(
+            client, "POST", httpx.URL(upload_url).join("upload_raw"), make_content, headers, max_attempts,
+        )
+        # 不可重放的流已被消费，无法再发送到回退地址
+        if response.status_code != 404 or not replayable:
+            return response
+        logger.info("文件床 '%s' 没有 /upload_raw 端点，改用旧版 JSON 格式上传。", upload_url)
+        _raw_endpoint_missing.add(upload_url)
+    return await _post_legacy_json(client, upload_url, file_name, media_type, make_content, api_key, max_attempts)
+
+async def _upload(file_name: str, media_type: str, make_content: Callable[[], bytes | AsyncIterator[bytes]], replayable: bool, upload_url: str, api_key: str | None, content_length: int | None = None, presigned: bool = False) -> UploadResult:
+    """上传的公共流程：熔断检查、（可选的预签名）带重试的上传请求、解析文件床响应并统一处理错误。"""
+    breaker = _breakers.setdefault(upload_url, _BreakerState())
+    if not _breaker_allow(breaker):
+        logger.warning("文件床 '%s' 熔断器处于打开状态，跳过上传 '%s'。", upload_url, file_name)
+        return None, UploadError.CIRCUIT_OPEN, "circuit_open: 文件床暂时不可用，请稍后重试。"
+
+    try:
+        headers = {
+            "Content-Type": media_type or "application/octet-stream",
+            "X-File-Name": quote(file_name),
+            "X-API-Key": api_key or "",
+            # 明确标记为原始字节上传：文件床不再根据 Content-Type（文件自身的媒体类型）选择解析方式
+            "X-Upload-Format": "raw",
+        }
+        if content_length is not None:
+            # 流式请求体默认使用分块传输编码，已知长度时显式声明 Content-Length
+            headers["Content-Length"] = str(content_length)
+        client = await _get_client()
+        max_attempts = RETRY_MAX_ATTEMPTS if replayable else 1
+        try:
+            if presigned:
+                response = await _upload_presigned(
+                    client, upload_url, file_name, media_type, make_content, max_attempts, api_key, content_length,
+                )
             else:
-                error_msg = result.get("error", "文件床返回了未知的错误。")
-                logger.error(f"上传到文件床失败: {error_msg}")
-                return None, error_msg
-                
+                response = await _post_raw(
+                    client, upload_url, file_name, media_type, make_content, headers, api_key, max_attempts, replayable,
+                )
+        except httpx.PoolTimeout:
+            # 本地连接池饱和，与文件床健康状况无关，不计入熔断
+            breaker.probing = False
+            raise
+        except httpx.RequestError:
+            _breaker_record(breaker, upload_url, ok=False)
+            raise
+        except BaseException:
+            breaker.probing = False
+            raise
+        _breaker_record(breaker, upload_url, ok=response.status_code < 500)
+
+        response.raise_for_status()  # 如果状态码是 4xx 或 5xx，则引发异常
+
+        result = orjson.loads(response.content)
+        uploaded_filename = result.get("filename")
+        if result.get("success") and uploaded_filename:
+            logger.info("文件 '%s' 成功上传到文件床，文件名为: %s", file_name, uploaded_filename)
+            return uploaded_filename, None, ""
+        else:
+            error_msg = result.get("error", "文件床返回了未知的错误。")
+            logger.error("上传到文件床失败: %s", error_msg)
+            return None, UploadError.SERVER_REPORTED, error_msg
+
     except httpx.HTTPStatusError as e:
-        error_details = f"HTTP 错误: {e.response.status_code} - {e.response.text}"
-        logger.error(f"上传到文件床时发生 {error_details}")
-        return None, error_details
+        # 只截取响应体的前 2KB 并按字节解码，避免对可能很大的错误响应做完整的字符集检测与解码
+        error_body = e.response.content[:_ERROR_BODY_LIMIT].decode("utf-8", "replace")
+        error_details = f"HTTP 错误: {e.response.status_code} - {error_body}"
+        logger.error("上传到文件床时发生 %s", error_details)
+        return None, UploadError.HTTP_5XX if e.response.status_code >= 500 else UploadError.HTTP_4XX, error_details
+    except _PresignError as e:
+        logger.error("申请预签名上传地址失败: %s", e)
+        return None, UploadError.SERVER_REPORTED, str(e)
+    except orjson.JSONDecodeError as e:
+        error_details = f"文件床返回了无效的 JSON: {e}"
+        logger.error("解析文件床响应时出错: %s", error_details)
+        return None, UploadError.UNKNOWN, error_details
+    except ValueError as e:
+        # 流式解码请求体时发现非法 base64 数据：属于调用方的数据问题，不计入熔断，也不重试
+        logger.error("解码 base64 数据时出错: %s", e)
+        return None, UploadError.INVALID_DATA, f"无效的 base64 数据: {e}"
     except httpx.RequestError as e:
-        error_details = f"连接错误: {e}"
-        logger.error(f"连接到文件床服务器时出错: {e}")
-        return None, error_details
-    except Exception as e:
-        error_details = f"未知错误: {e}"
-        logger.error(f"上传文件时发生未知错误: {e}", exc_info=True)
-        return None, error_details
+        error_details = f"{_TIMEOUT_ERROR_LABELS.get(type(e), '连接错误')}: {e}"
+        logger.error("连接到文件床服务器时出错: %s", error_details)
+        return None, UploadError.TIMEOUT if isinstance(e, httpx.TimeoutException) else UploadError.CONNECT, error_details
+
+async def upload_data_uri_to_file_bed(file_name: str, file_data: str, upload_url: str, api_key: str | None = None) -> Tuple[str | None, str | None]:
+    """
+    [已弃用] 旧版接口：接收 base64 data URI 并上传，返回旧格式的 (filename, error_message)。
+    请改用 upload_to_file_bed(file_name, media_type, data, ...)，
+    或在只有 base64 文本时使用 split_data_uri() + upload_base64_to_file_bed()。
+    """
+    warnings.warn(
+        "upload_data_uri_to_file_bed 已弃用，请改用 upload_to_file_bed(file_name, media_type, data, ...)。",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    try:
+        media_type, payload_start = split_data_uri(file_data)
+        payload_b64 = memoryview(file_data.encode("ascii"))[payload_start:]
+    except ValueError as e:
+        logger.error("解析 data URI 时出错: %s", e)
+        return None, f"无效的 data URI: {e}"
+    filename, error, error_message = await upload_base64_to_file_bed(file_name, media_type, payload_b64, upload_url, api_key)
+    return filename, error_message if error else None